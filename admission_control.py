@@ -0,0 +1,91 @@
+import math
+import os
+from flask import jsonify
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# ✅ Admission limits for the whole node: the web workers' schedulers share their load (see scheduler.node_snapshot)
+ADMISSION_MAX_PENDING_PAGES = int(os.getenv("ADMISSION_MAX_PENDING_PAGES", 400))
+ADMISSION_MAX_USER_PAGES = int(os.getenv("ADMISSION_MAX_USER_PAGES", 200))
+ADMISSION_MAX_ACTIVE_DOCUMENTS = int(os.getenv("ADMISSION_MAX_ACTIVE_DOCUMENTS", 32))
+ADMISSION_MIN_FREE_MEMORY_MB = int(os.getenv("ADMISSION_MIN_FREE_MEMORY_MB", 512))
+DEFAULT_PAGE_SECONDS = float(os.getenv("DEFAULT_PAGE_SECONDS", 5))
+MAX_RETRY_AFTER = 600
+
+
+class Rejection:
+    """ Why a job was turned away, and when the client should try again """
+
+    def __init__(self, status, message, retry_after):
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after
+
+    def to_response(self):
+        response = jsonify({"error": self.message, "retry_after": self.retry_after})
+        response.status_code = self.status
+        response.headers["Retry-After"] = str(self.retry_after)
+        return response
+
+
+def available_memory_mb():
+    """ MemAvailable from /proc/meminfo, or None where that isn't available """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return None
+
+
+def estimate_retry_after(stats, pages_to_drain):
+    """ Seconds until `pages_to_drain` pages would clear the scheduler at its current pace """
+    page_seconds = stats.get("avg_page_seconds") or DEFAULT_PAGE_SECONDS
+    seconds = math.ceil(max(pages_to_drain, 1) * page_seconds / max(stats["capacity"], 1))
+    return min(max(seconds, 1), MAX_RETRY_AFTER)
+
+
+def _pending_pages(stats):
+    return stats["queued_pages"] + stats["in_flight_pages"]
+
+
+def check_capacity(stats):
+    """ Cheap node-wide check, run before the upload body is read """
+    pending = _pending_pages(stats)
+    if pending >= ADMISSION_MAX_PENDING_PAGES:
+        return Rejection(503, "Server is busy, please retry later",
+                         estimate_retry_after(stats, pending - ADMISSION_MAX_PENDING_PAGES + 1))
+
+    active_documents = sum(user["active_documents"] for user in stats["users"].values())
+    if active_documents >= ADMISSION_MAX_ACTIVE_DOCUMENTS:
+        return Rejection(503, "Server is busy, please retry later", estimate_retry_after(stats, stats["in_flight_pages"]))
+
+    free_mb = available_memory_mb()
+    if free_mb is not None and free_mb < ADMISSION_MIN_FREE_MEMORY_MB:
+        return Rejection(503, "Server is low on memory, please retry later", estimate_retry_after(stats, stats["in_flight_pages"]))
+    return None
+
+
+def check_job(stats, username, new_pages, new_documents):
+    """
+    Full check once the job's page count is known. Per-user quota -> 429, node saturation -> 503.
+    A job larger than a limit is still admitted when nothing else is pending, so it can't be refused forever.
+    """
+    user = stats["users"].get(username, {"active_documents": 0, "in_flight_pages": 0, "queued_pages": 0})
+    user_pending = user["queued_pages"] + user["in_flight_pages"]
+    if user_pending > 0 and user_pending + new_pages > ADMISSION_MAX_USER_PAGES:
+        return Rejection(429, "Too many pages in progress for this user",
+                         estimate_retry_after(stats, user_pending + new_pages - ADMISSION_MAX_USER_PAGES))
+
+    pending = _pending_pages(stats)
+    if pending > 0 and pending + new_pages > ADMISSION_MAX_PENDING_PAGES:
+        return Rejection(503, "Server is busy, please retry later",
+                         estimate_retry_after(stats, pending + new_pages - ADMISSION_MAX_PENDING_PAGES))
+
+    active_documents = sum(u["active_documents"] for u in stats["users"].values())
+    if active_documents > 0 and active_documents + new_documents > ADMISSION_MAX_ACTIVE_DOCUMENTS:
+        return Rejection(503, "Server is busy, please retry later", estimate_retry_after(stats, stats["in_flight_pages"]))
+    return None
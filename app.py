@@ -1,46 +1,105 @@
 from flask import Flask, request, jsonify, send_file, stream_with_context, Response, session
-from flask_session import Session  # ✅ Import Flask-Session
 import multiprocessing
 import os
 import secrets
 import json
-import tempfile
 from initialize_database import init_db, get_db
 from user_authentication import authenticate_user, hash_password
-from pdf_processing import process_pdf
-from email_verification import send_email_verification
+from pdf_processing import process_pdf, save_extraction_history
+from data_extraction import create_context_cache, delete_context_cache
+from email_verification import build_verification_email
+from email_outbox import enqueue_email, start_sender
 from credentials_validation import is_valid_username, is_strong_password, is_valid_email
+import session_store
+from scheduler import get_scheduler, get_user_share_weight
+from admission_control import check_capacity, check_job
+from work_queue import EXECUTION_MODE, enqueue_document, poll_job, cancel_job, collect_traces, add_queue_load
+from row_store import stream_rows, RowWriter
+from artifact_store import store_artifact, artifact_path, start_sweeper, store_result, load_result
+import upload_ingestion
+from regions import parse_regions
+from template_registry import get_template, list_templates, save_template, delete_template, validate_template
+from tracing import parse_trace_mode, read_trace, merge_traces, write_trace
+from upload_ingestion import ingest_upload, get_upload_job, result_cache_key, UploadRejected, MAX_PAGES_PER_REQUEST
 import time
 from datetime import datetime, timedelta  # Import datetime and timedelta
 import psycopg2
 import psycopg2.extras
 from psycopg2.extras import DictCursor
-from pdf2image import convert_from_path
 import bcrypt
-import pandas as pd
 from flask_cors import CORS
 from dotenv import load_dotenv
 
 app = Flask(__name__)
 CORS(app)
+load_dotenv()
+
 # ✅ Configure Flask session to persist data
 app.config["SESSION_PERMANENT"] = False
-app.config["SESSION_TYPE"] = "filesystem"  # Uses file-based session storage
-Session(app)  # ✅ Initialize session
+app.config['SECRET_KEY'] = os.getenv("SECRET_KEY", 'Genaiapplication')  # Must match on every node
+session_store.init_app(app)  # ✅ Shared session backend, no sticky routing needed
+upload_ingestion.init_app(app)  # ✅ Stream uploads straight into the artifact store
 
-load_dotenv()
 
-app.config['SECRET_KEY'] = 'Genaiapplication'
+def current_load():
+    """ The node's scheduler load (every web worker), plus the shared work queue's in distributed mode """
+    stats = get_scheduler().node_snapshot()
+    if EXECUTION_MODE == "distributed":
+        stats = add_queue_load(stats)
+    return stats
 
-init_db()
 
+@app.before_request
+def start_background_tasks():
+    """ Starts per-worker background threads on the first request instead of at import time """
+    start_sweeper()  # ✅ Evict expired uploads and outputs in the background
+    session_store.start_cleanup(app)  # ✅ Drop expired server-side sessions
+    if os.getenv("EMAIL_OUTBOX_INPROCESS", "1") == "1":
+        start_sender()  # ✅ Otherwise run `python email_outbox.py` separately
 
-def save_extracted_data_to_excel(extracted_data, filename):
+
+def save_extracted_data_to_excel(extracted_data, job_dir, filename):
+    import pandas as pd  # Heavy import, only paid when an Excel file is written
     df = pd.DataFrame(extracted_data)
-    excel_path = os.path.join(tempfile.gettempdir(), filename)
+    excel_path = os.path.join(job_dir, filename)
     df.to_excel(excel_path, index=False)
-    print(f"Excel file saved at: {excel_path}")
-    return excel_path
+    artifact_name = store_artifact(excel_path)
+    print(f"Excel file stored as artifact: {artifact_name}")
+    return artifact_name
+
+
+def replay_cached_result(cached, upload, username, queue, total_pages_global, job_id):
+    """ Feeds a stored result through the progress queue as if it had just been processed """
+    document_name = upload["document_name"]
+    total_pages = cached.get("total_pages") or upload["pages"]
+    extracted_data = cached.get("extracted_data", [])
+    row_writer = RowWriter(job_id, username)
+    for item in extracted_data:
+        item["document_name"] = document_name
+        row_writer.add(document_name, item.get("page_number"), [item])
+    row_writer.close()  # ✅ The new job_id gets its own rows in extracted_rows
+
+    for page_number in range(1, total_pages + 1):
+        queue.put({
+            "document_name": document_name,
+            "page_number": page_number,
+            "total_pages": total_pages,
+            "progress": round((page_number / total_pages) * 100, 2),
+            "total_pages_global": total_pages_global,
+            "current_page_processed": 1
+        })
+
+    save_extraction_history(username, document_name, len(extracted_data), 0)
+    queue.put({
+        "completed": True,
+        "cached": True,
+        "document_name": document_name,
+        "total_time": 0,
+        "total_rows_extracted": len(extracted_data),
+        "avg_time_per_row": 0,
+        "skipped_pages": [],
+        "extracted_data": extracted_data
+    })
 
 
 @app.route("/register", methods=["POST"])
@@ -86,14 +145,12 @@ def register_user():
             VALUES (%s, %s, %s)
         """, (email, verification_token, expiry_time))
 
-        conn.commit()
-
-        # Send Verification Email
+        # Queue Verification Email, committed together with the new user
         verification_link = f"https://yourfrontend.com/verify-email?token={verification_token}"
-        email_sent = send_email_verification(email, verification_link)
+        subject, body = build_verification_email(verification_link)
+        enqueue_email(cursor, email, subject, body)
 
-        if not email_sent:
-            return jsonify({"error": "Failed to send verification email. Try again later."}), 500
+        conn.commit()
 
         return jsonify({"message": "User registered! Please check your email for verification."}), 201
 
@@ -243,7 +300,13 @@ def logout():
 
 @app.route("/extract_text_stream", methods=["POST"])
 def process_pdfs_stream():
-    if "pdf" not in request.files or "prompt" not in request.form or "username" not in request.form or "password" not in request.form:
+    # ✅ Refuse early, before the upload body is read, when this worker is saturated
+    rejection = check_capacity(current_load())
+    if rejection:
+        return rejection.to_response()
+
+    has_prompt = request.form.get("prompt") or request.form.get("template_id")
+    if "pdf" not in request.files or not has_prompt or "username" not in request.form or "password" not in request.form:
         return jsonify({"error": "Missing required parameters"}), 400
 
     username = request.form["username"]
@@ -253,100 +316,310 @@ def process_pdfs_stream():
         return jsonify({"error": "Invalid credentials"}), 401
 
     pdf_files = request.files.getlist("pdf")
-    prompt = request.form["prompt"]
 
-    temp_dir = tempfile.mkdtemp()
-    pdf_paths = []
+    # ✅ A stored template supplies the prompt, regions, model, output schema and image settings
+    template = None
+    if request.form.get("template_id"):
+        template = get_template(request.form["template_id"])
+        if template is None:
+            return jsonify({"error": "Template not found"}), 404
+    prompt = request.form.get("prompt") or template["prompt"]
+    priority = request.form.get("priority")  # "interactive" or "bulk", inferred from size if missing
+
+    # ✅ Optional job deadline: return whatever is done within this many seconds
+    deadline = None
+    if request.form.get("deadline_seconds"):
+        try:
+            deadline_seconds = float(request.form["deadline_seconds"])
+        except ValueError:
+            return jsonify({"error": "deadline_seconds must be a number"}), 400
+        if deadline_seconds <= 0:
+            return jsonify({"error": "deadline_seconds must be positive"}), 400
+        deadline = time.time() + deadline_seconds
+        priority = priority or "interactive"  # Someone is waiting on it
+
+    # ✅ Optional regions of interest: only these parts of each page are sent to the model
+    regions = template["regions"] if template else None
+    if request.form.get("regions"):
+        try:
+            regions = parse_regions(request.form["regions"])
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+    # ✅ Optional profiling: trace every page's lifecycle ("trace"), plus stack samples ("profile")
+    try:
+        trace_mode = parse_trace_mode(request.form.get("trace"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    uploads = []
     total_pages_global = 0  # ✅ Track total pages globally
 
     for pdf_file in pdf_files:
-        original_filename = pdf_file.filename
-        safe_filename = "".join(c for c in original_filename if c.isalnum() or c in (" ", ".", "_")).strip()
-        pdf_path = os.path.join(temp_dir, safe_filename)
-        pdf_file.save(pdf_path)
-        pdf_paths.append(pdf_path)
+        try:
+            upload = ingest_upload(pdf_file)
+        except UploadRejected as e:
+            return jsonify({"error": str(e)}), 413
+
+        total_pages_global += upload["pages"]
+        if total_pages_global > MAX_PAGES_PER_REQUEST:
+            return jsonify({"error": f"Too many pages in one request, the limit is {MAX_PAGES_PER_REQUEST}"}), 413
 
-        # ✅ Count total pages per PDF before processing
-        images = convert_from_path(pdf_path, fmt="jpeg")
-        total_pages_global += len(images)
+        upload["cache_key"] = result_cache_key(upload["sha256"], prompt, regions, template)
+        uploads.append(upload)
 
+    job_id, temp_dir = get_upload_job()
+    trace_dir = os.path.join(temp_dir, "trace")
     print(f"Total pages across all PDFs: {total_pages_global}")
 
+    rejection = check_job(current_load(), username, total_pages_global, len(uploads))
+    if rejection:
+        return rejection.to_response()
+
     queue = multiprocessing.Queue()
     processes = []
     processed_pages = 0  # ✅ Track pages processed globally
-
-    for pdf_path in pdf_paths:
-        process = multiprocessing.Process(target=process_pdf, args=(pdf_path, prompt, username, queue, total_pages_global))
+    cache_keys = {}
+    scheduler = get_scheduler()
+    share_weight = get_user_share_weight(username)
+    job_keys = []
+    distributed_documents = []
+    context_cache = None
+
+    for upload in uploads:
+        cached = load_result(upload["cache_key"])
+        if cached is not None:
+            # ✅ Same PDF + prompt already extracted, replay the stored result
+            print(f"Serving cached result for: {upload['document_name']}")
+            replay_cached_result(cached, upload, username, queue, total_pages_global, job_id)
+            continue
+
+        if not cache_keys:
+            # ✅ One context cache for a long prompt, shared by every document of the job
+            context_cache = create_context_cache(prompt, template["model"] if template else None)
+        cache_keys[upload["document_name"]] = upload["cache_key"]
+        if EXECUTION_MODE == "distributed":
+            # ✅ Page ranges go to the shared work queue, any node's workers can claim them
+            enqueue_document(job_id, username, upload["document_name"], upload["path"], upload["sha256"], upload["pages"], prompt, deadline, regions, trace_mode,
+                             template["template_id"] if template else None, context_cache)
+            distributed_documents.append(upload["document_name"])
+            continue
+
+        job_key = f"{job_id}:{upload['document_name']}"
+        page_gate = scheduler.register_job(job_key, username, upload["pages"], share_weight, priority)
+        job_keys.append(job_key)
+        process = multiprocessing.Process(target=process_pdf, args=(upload["path"], prompt, username, queue, total_pages_global, page_gate, job_id, deadline, regions,
+                                                                    trace_mode, trace_dir, template, context_cache))
         processes.append(process)
         process.start()
 
+    def record_history(result):
+        save_extraction_history(username, result["document_name"], result["total_rows_extracted"], result["total_time"])
+
+    def messages():
+        # Local workers and cached replays report through the queue, distributed ones through page_tasks
+        local_documents = len(uploads) - len(distributed_documents)
+        while local_documents > 0:
+            data = queue.get()
+            if "completed" in data:
+                local_documents -= 1
+            yield data
+        if distributed_documents:
+            yield from poll_job(job_id, total_pages_global, on_document_done=record_history, deadline=deadline)
+
     def generate():
         nonlocal processed_pages
         all_extracted_data = []
         total_time = 0
         total_rows_extracted = 0
         skipped_pages = []
-        active_processes = len(pdf_paths)
+        unprocessed_pages = {}
+        deadline_stops = set()
+        document_errors = {}
         document_progress = {}
-
-        while active_processes > 0:
-            data = queue.get()
-
-            if "document_name" in data and "progress" in data:
-                doc_name = data["document_name"]
-                doc_progress = data["progress"]
-                document_progress[doc_name] = doc_progress  
-
-                # ✅ Yield per-document progress
-                yield f"data: {json.dumps({'document_name': doc_name, 'progress': doc_progress})}\n\n"
-
-            if "current_page_processed" in data:
-                processed_pages += 1  
-                total_progress = round((processed_pages / total_pages_global) * 100, 2)
-
-                # ✅ Yield total progress dynamically
-                yield f"data: {json.dumps({'total_progress': total_progress})}\n\n"
-
-            if "extracted_data" in data and isinstance(data["extracted_data"], list):
-                all_extracted_data.extend(data["extracted_data"])
-            if "skipped_pages" in data and isinstance(data["skipped_pages"], list):
-                skipped_pages.extend(data["skipped_pages"])
-
-            if "total_time" in data:
-                total_time += data["total_time"]
-            if "total_rows_extracted" in data:
-                total_rows_extracted += data["total_rows_extracted"]
-
-            if "completed" in data:
-                active_processes -= 1  
-
-        for process in processes:
-            process.join()
+        finished = False
+
+        try:
+            for data in messages():
+                if "document_name" in data and "progress" in data:
+                    doc_name = data["document_name"]
+                    doc_progress = data["progress"]
+                    document_progress[doc_name] = doc_progress  
+
+                    # ✅ Yield per-document progress
+                    yield f"data: {json.dumps({'document_name': doc_name, 'progress': doc_progress})}\n\n"
+
+                if "current_page_processed" in data:
+                    processed_pages += 1  
+                    total_progress = round((processed_pages / total_pages_global) * 100, 2)
+
+                    # ✅ Yield total progress dynamically
+                    yield f"data: {json.dumps({'total_progress': total_progress})}\n\n"
+
+                if "extracted_data" in data and isinstance(data["extracted_data"], list):
+                    all_extracted_data.extend(data["extracted_data"])
+                if "skipped_pages" in data and isinstance(data["skipped_pages"], list):
+                    skipped_pages.extend(data["skipped_pages"])
+
+                if "total_time" in data:
+                    total_time += data["total_time"]
+                if "total_rows_extracted" in data:
+                    total_rows_extracted += data["total_rows_extracted"]
+
+                if data.get("unprocessed_pages"):
+                    unprocessed_pages[data["document_name"]] = data["unprocessed_pages"]
+                if data.get("stopped_for_deadline"):
+                    deadline_stops.add(data["document_name"])
+                if data.get("error") or data.get("task_errors"):
+                    document_errors[data.get("document_name")] = data.get("error") or "; ".join(data["task_errors"])
+
+                if "completed" in data:
+                    scheduler.finish_job(f"{job_id}:{data.get('document_name')}")
+
+                    # ✅ Remember complete results so identical uploads skip re-processing
+                    cache_key = cache_keys.get(data.get("document_name"))
+                    if cache_key and not data.get("skipped_pages") and not data.get("unprocessed_pages") and "error" not in data:
+                        store_result(cache_key, {
+                            "total_pages": data.get("total_pages"),
+                            "extracted_data": data.get("extracted_data", []),
+                        })
+            finished = True
+        finally:
+            # ✅ Hand back any scheduler slots, even if the client disconnected
+            for job_key in job_keys:
+                scheduler.finish_job(job_key)
+            if distributed_documents and not finished:
+                cancel_job(job_id)
+            for process in processes:
+                if not finished and process.is_alive():
+                    process.terminate()  # ✅ Nobody is reading its results any more
+                process.join()
+            if context_cache:
+                delete_context_cache(context_cache)  # ✅ Don't pay for its storage until the TTL
 
         # ✅ Save final extracted data
-        if all_extracted_data:
+        if all_extracted_data or unprocessed_pages or document_errors or trace_mode:
             total_time = round(total_time, 2)
             avg_time_per_row = round(total_time / total_rows_extracted, 2) if total_rows_extracted > 0 else 0
-            timestamp = int(time.time())
-            combined_filename = f"output_data_{timestamp}.xlsx"
-            combined_path = save_extracted_data_to_excel(all_extracted_data, combined_filename)
+            final = {'completed': True, 'job_id': job_id, 'total_time': total_time, 'total_rows_extracted': total_rows_extracted, 'avg_time_per_row': avg_time_per_row}
+            if all_extracted_data:
+                timestamp = int(time.time())
+                combined_filename = f"output_data_{timestamp}.xlsx"
+                artifact_name = save_extracted_data_to_excel(all_extracted_data, temp_dir, combined_filename)
+                final['download_link'] = f'/download_excel?filename={artifact_name}'
+            if unprocessed_pages:
+                final['unprocessed_pages'] = unprocessed_pages
+                # ✅ Workers report deadline stops themselves: they stop up to MIN_PAGE_SECONDS early
+                if deadline_stops:
+                    final['deadline_reached'] = True  # Partial results, with the pages that were never started
+                for doc_name in unprocessed_pages:
+                    if doc_name not in deadline_stops:
+                        document_errors.setdefault(doc_name, "Some pages were not processed")
+            if document_errors:
+                final['errors'] = document_errors
+            if trace_mode:
+                # ✅ Merge every worker's trace into one Chrome trace, kept after the job dir is removed
+                trace = read_trace(trace_dir)
+                if distributed_documents:
+                    trace = merge_traces([trace] + collect_traces(job_id))
+                trace_name = store_artifact(write_trace(trace, os.path.join(temp_dir, "trace.json")))
+                final['trace_link'] = f'/download_trace?filename={trace_name}'
 
             # ✅ Final yield with completion status & download link
-            yield f"data: {json.dumps({'completed': True, 'download_link': f'/download_excel?filename={combined_filename}', 'total_time': total_time, 'total_rows_extracted': total_rows_extracted, 'avg_time_per_row': avg_time_per_row})}\n\n"
+            yield f"data: {json.dumps(final)}\n\n"
 
+    # ✅ The job directory is removed by the teardown handler once the stream ends
     return Response(stream_with_context(generate()), content_type="text/event-stream")
 
 
 @app.route("/download_excel", methods=["GET"])
 def download_excel():
     filename = request.args.get("filename")
-    file_path = os.path.join(tempfile.gettempdir(), filename)
-    if os.path.exists(file_path):
-        return send_file(file_path, as_attachment=True)
+    file_path = artifact_path(filename)
+    if file_path:
+        # ✅ Artifact names are content-addressed, so they double as a strong ETag
+        return send_file(file_path, as_attachment=True, download_name="output_data.xlsx",
+                         etag=filename.split(".")[0], conditional=True, max_age=3600)
+    return jsonify({"error": "File not found"}), 404
+
+
+@app.route("/download_trace", methods=["GET"])
+def download_trace():
+    filename = request.args.get("filename")
+    file_path = artifact_path(filename)
+    if file_path and filename.endswith(".json"):
+        # ✅ Open in chrome://tracing or https://ui.perfetto.dev
+        return send_file(file_path, as_attachment=True, download_name="trace.json", mimetype="application/json",
+                         etag=filename.split(".")[0], conditional=True, max_age=3600)
     return jsonify({"error": "File not found"}), 404
 
 
+@app.route("/extracted_rows", methods=["POST"])
+def query_extracted_rows():
+    """ Streams stored rows as JSON lines, filtered by job_id and/or document_name """
+    data = request.get_json()
+    username = data.get("username")
+    password = data.get("password")
+
+    if not authenticate_user(username, password):
+        return jsonify({"error": "Invalid credentials"}), 401
+
+    job_id = data.get("job_id")
+    document_name = data.get("document_name")
+    if not job_id and not document_name:
+        return jsonify({"error": "job_id or document_name is required"}), 400
+
+    # ✅ Non-admins only ever see their own rows
+    owner = None if username == "admin" else username
+
+    def generate():
+        for row in stream_rows(username=owner, job_id=job_id, document_name=document_name):
+            yield json.dumps(row) + "\n"
+
+    return Response(stream_with_context(generate()), content_type="application/x-ndjson")
+
+
+@app.route("/templates", methods=["POST"])
+def get_templates():
+    data = request.get_json()
+    if not authenticate_user(data.get("username"), data.get("password")):
+        return jsonify({"error": "Invalid credentials"}), 401
+    return jsonify({"templates": list_templates()})
+
+
+@app.route("/save_template", methods=["POST"])
+def save_extraction_template():
+    """ Creates or replaces a template (admin only). Returns its new version. """
+    data = request.get_json()
+    admin_username = data.get("admin_username")
+    admin_password = data.get("admin_password")
+
+    if admin_username != "admin" or not authenticate_user(admin_username, admin_password):
+        return jsonify({"error": "Only admin can manage templates"}), 403
+
+    try:
+        template = validate_template(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    version = save_template(template, admin_username)
+    return jsonify({"message": "Template saved", "template_id": template["template_id"], "version": version}), 200
+
+
+@app.route("/remove_template", methods=["POST"])
+def remove_extraction_template():
+    data = request.get_json()
+    admin_username = data.get("admin_username")
+    admin_password = data.get("admin_password")
+
+    if admin_username != "admin" or not authenticate_user(admin_username, admin_password):
+        return jsonify({"error": "Only admin can manage templates"}), 403
+
+    if not delete_template(data.get("template_id")):
+        return jsonify({"error": "Template not found"}), 404
+    return jsonify({"message": f"Template '{data.get('template_id')}' removed"}), 200
+
+
 @app.route("/user_list", methods=["GET"])
 def get_user_list():
     conn = get_db()
@@ -457,16 +730,23 @@ def get_user_statistics():
     user_stats = cursor.fetchall()
     conn.close()
 
+    # ✅ Live page counts from this worker's scheduler and the shared work queue
+    scheduler_stats = current_load()
+    live_users = scheduler_stats.pop("users")
+    idle = {"active_documents": 0, "in_flight_pages": 0, "queued_pages": 0}
+
     return jsonify({
         "user_statistics": [
             {
                 "username": row["username"],
                 "total_documents": row["total_documents"],
                 "total_rows": row["total_rows"],
-                "avg_time_per_row": round(row["total_time"] / row["total_rows"], 2) if row["total_rows"] > 0 else 0
+                "avg_time_per_row": round(row["total_time"] / row["total_rows"], 2) if row["total_rows"] > 0 else 0,
+                **live_users.get(row["username"], idle)
             }
             for row in user_stats
-        ]
+        ],
+        "scheduler": {**scheduler_stats, "users": live_users}
     })
 
 
@@ -591,4 +871,5 @@ def remove_all_users():
 
 
 if __name__ == "__main__":
+    init_db()  # ✅ Dev server convenience; deployments run `python migrations.py` once instead
     app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
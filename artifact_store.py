@@ -0,0 +1,203 @@
+import hashlib
+import hmac
+import json
+import os
+import re
+import secrets
+import shutil
+import tempfile
+import threading
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# ✅ Artifact store configuration
+ARTIFACT_ROOT = os.getenv("ARTIFACT_ROOT", os.path.join(tempfile.gettempdir(), "swiftextract_artifacts"))
+ARTIFACT_TTL_SECONDS = int(os.getenv("ARTIFACT_TTL_SECONDS", 24 * 60 * 60))
+JOB_DIR_TTL_SECONDS = int(os.getenv("JOB_DIR_TTL_SECONDS", 6 * 60 * 60))
+ARTIFACT_QUOTA_BYTES = int(os.getenv("ARTIFACT_QUOTA_BYTES", 5 * 1024 ** 3))
+ARTIFACT_SWEEP_INTERVAL = int(os.getenv("ARTIFACT_SWEEP_INTERVAL", 300))
+
+# Key used to derive artifact names. Names are content-addressed (same bytes -> same name)
+# but cannot be guessed without the key. Set it in .env so names stay stable across restarts.
+ARTIFACT_KEY = os.getenv("ARTIFACT_KEY", secrets.token_hex(32)).encode("utf-8")
+
+JOBS_DIR = os.path.join(ARTIFACT_ROOT, "jobs")
+BLOBS_DIR = os.path.join(ARTIFACT_ROOT, "blobs")
+RESULTS_DIR = os.path.join(ARTIFACT_ROOT, "results")
+
+ARTIFACT_NAME_RE = re.compile(r"^[0-9a-f]{64}\.[a-z0-9]{1,8}$")
+RESULT_KEY_RE = re.compile(r"^[0-9a-f]{64}$")
+JOB_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+_sweeper_lock = threading.Lock()
+_sweeper_thread = None
+
+
+def _ensure_dirs():
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    os.makedirs(BLOBS_DIR, exist_ok=True)
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+
+
+def create_job_dir():
+    """ Creates a private working directory for one request and returns (job_id, path) """
+    _ensure_dirs()
+    job_id = secrets.token_hex(16)
+    job_dir = os.path.join(JOBS_DIR, job_id)
+    os.makedirs(job_dir)
+    return job_id, job_dir
+
+
+def job_dir_path(job_id):
+    if not JOB_ID_RE.match(job_id or ""):
+        return None
+    return os.path.join(JOBS_DIR, job_id)
+
+
+def remove_job_dir(job_id):
+    job_dir = job_dir_path(job_id)
+    if job_dir:
+        shutil.rmtree(job_dir, ignore_errors=True)
+
+
+def _artifact_name(file_path, extension):
+    digest = hmac.new(ARTIFACT_KEY, digestmod=hashlib.sha256)
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return f"{digest.hexdigest()}.{extension}"
+
+
+def store_artifact(file_path):
+    """
+    Moves a finished file into the store and returns its artifact name.
+    Identical content maps to the same name, so repeat outputs are stored once.
+    """
+    _ensure_dirs()
+    extension = os.path.splitext(file_path)[1].lstrip(".").lower() or "bin"
+    name = _artifact_name(file_path, extension)
+    target = os.path.join(BLOBS_DIR, name)
+
+    if os.path.exists(target):
+        os.remove(file_path)
+        os.utime(target)  # ✅ Refresh age so the existing copy is kept
+    else:
+        os.replace(file_path, target)
+    return name
+
+
+def artifact_path(name):
+    """ Resolves an artifact name to its path, or None if it is invalid or gone """
+    if not name or not ARTIFACT_NAME_RE.match(name):
+        return None
+    path = os.path.join(BLOBS_DIR, name)
+    if not os.path.exists(path):
+        return None
+    os.utime(path)  # ✅ Track last access for LRU eviction
+    return path
+
+
+def store_result(key, result):
+    """ Saves a computed extraction result under its cache key """
+    if not RESULT_KEY_RE.match(key or ""):
+        return
+    _ensure_dirs()
+    path = os.path.join(RESULTS_DIR, f"{key}.json")
+    tmp_path = f"{path}.{secrets.token_hex(4)}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(result, f)
+    os.replace(tmp_path, path)  # ✅ Atomic, readers never see a half-written file
+
+
+def load_result(key):
+    """ Returns a cached extraction result, or None if it was never stored or has been evicted """
+    if not RESULT_KEY_RE.match(key or ""):
+        return None
+    path = os.path.join(RESULTS_DIR, f"{key}.json")
+    try:
+        with open(path, encoding="utf-8") as f:
+            result = json.load(f)
+    except (OSError, ValueError):
+        return None
+    os.utime(path)
+    return result
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return total
+
+
+def sweep():
+    """ Evicts expired job directories and artifacts, then enforces the disk quota """
+    _ensure_dirs()
+    now = time.time()
+    removed = 0
+
+    for job_id in os.listdir(JOBS_DIR):
+        job_dir = os.path.join(JOBS_DIR, job_id)
+        try:
+            if now - os.path.getmtime(job_dir) > JOB_DIR_TTL_SECONDS:
+                shutil.rmtree(job_dir, ignore_errors=True)
+                removed += 1
+        except OSError:
+            pass
+
+    entries = []
+    blobs = [os.path.join(BLOBS_DIR, name) for name in os.listdir(BLOBS_DIR)]
+    results = [os.path.join(RESULTS_DIR, name) for name in os.listdir(RESULTS_DIR)]
+    for path in blobs + results:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        if now - stat.st_mtime > ARTIFACT_TTL_SECONDS:
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+        else:
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    # ✅ Over quota: evict least recently used artifacts first
+    total_bytes = sum(size for _, size, _ in entries) + _dir_size(JOBS_DIR)
+    for _, size, path in sorted(entries):
+        if total_bytes <= ARTIFACT_QUOTA_BYTES:
+            break
+        try:
+            os.remove(path)
+            total_bytes -= size
+            removed += 1
+        except OSError:
+            pass
+
+    if removed:
+        print(f"🧹 Artifact sweep removed {removed} item(s), {total_bytes} bytes in use")
+    return removed
+
+
+def _sweep_forever():
+    while True:
+        try:
+            sweep()
+        except Exception as e:
+            print(f"🚨 Artifact sweep error: {e}")
+        time.sleep(ARTIFACT_SWEEP_INTERVAL)
+
+
+def start_sweeper():
+    """ Starts the background sweeper thread once per process """
+    global _sweeper_thread
+    with _sweeper_lock:
+        if _sweeper_thread is None or not _sweeper_thread.is_alive():
+            _sweeper_thread = threading.Thread(target=_sweep_forever, name="artifact-sweeper", daemon=True)
+            _sweeper_thread.start()
@@ -0,0 +1,86 @@
+"""
+Startup benchmark for web and PDF workers.
+
+    python bench_startup.py                       # import cost of `app`, top modules
+    python bench_startup.py --pdf sample.pdf      # also fork-to-first-page time
+    python bench_startup.py --max-import-ms 800   # exit 1 if the budget is exceeded (CI)
+"""
+import argparse
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def measure_imports(module, top):
+    """ Runs `python -X importtime -c "import <module>"` in a fresh interpreter and parses its report """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    if result.returncode != 0:
+        print(result.stderr[-2000:])
+        raise SystemExit(f"🚨 Importing {module} failed")
+
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line.split(":", 1)[1].split("|")
+        rows.append((int(cumulative_us), int(self_us), name[1:].rstrip()))  # Leading spaces mark nesting
+
+    total_ms = next((cum for cum, _, name in rows if name == module), 0) / 1000
+    print(f"Import of '{module}': {total_ms:.1f} ms")
+    print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+    # Direct dependencies of the module (one nesting level), skipping interpreter startup
+    start = max((i for i, row in enumerate(rows) if row[2] == "site"), default=-1) + 1
+    direct = [row for row in rows[start:] if row[2].startswith("  ") and not row[2].startswith("    ")]
+    for cumulative_us, self_us, name in sorted(direct, reverse=True)[:top]:
+        print(f"{cumulative_us / 1000:>14.1f} {self_us / 1000:>9.1f}  {name.strip()}")
+    return total_ms
+
+
+def _first_page(pdf_path, started_at, result_queue):
+    import pdf_processing  # noqa: F401  (what a worker imports before doing any work)
+    from rasterizer import render_chunk
+    with tempfile.TemporaryDirectory() as temp_dir:
+        render_chunk(pdf_path, 1, 1, temp_dir)
+    result_queue.put(time.monotonic() - started_at)
+
+
+def measure_fork_to_first_page(pdf_path):
+    """ Time from Process.start() in the parent until the child has rasterized page 1 """
+    result_queue = multiprocessing.Queue()
+    started_at = time.monotonic()
+    process = multiprocessing.Process(target=_first_page, args=(pdf_path, started_at, result_queue))
+    process.start()
+    elapsed_ms = result_queue.get(timeout=120) * 1000
+    process.join()
+    print(f"Fork to first page: {elapsed_ms:.1f} ms")
+    return elapsed_ms
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure worker boot cost")
+    parser.add_argument("--module", default="app")
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--pdf", help="PDF used to measure fork-to-first-page time")
+    parser.add_argument("--max-import-ms", type=float)
+    parser.add_argument("--max-first-page-ms", type=float)
+    args = parser.parse_args()
+
+    failed = False
+    import_ms = measure_imports(args.module, args.top)
+    if args.max_import_ms is not None and import_ms > args.max_import_ms:
+        print(f"🚨 Import budget exceeded: {import_ms:.1f} ms > {args.max_import_ms} ms")
+        failed = True
+
+    if args.pdf:
+        first_page_ms = measure_fork_to_first_page(args.pdf)
+        if args.max_first_page_ms is not None and first_page_ms > args.max_first_page_ms:
+            print(f"🚨 First page budget exceeded: {first_page_ms:.1f} ms > {args.max_first_page_ms} ms")
+            failed = True
+
+    sys.exit(1 if failed else 0)
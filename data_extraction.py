@@ -1,88 +1,250 @@
 import time
-import base64
-from vertexai.generative_models import GenerativeModel, Part, SafetySetting
-import vertexai
 from dotenv import load_dotenv
 import os
 import json
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+from hedging import call_with_hedge
+from tracing import span, instant
 
 load_dotenv()
 
 # Google Cloud project details
 project = os.getenv("GENAI_PROJECT")
 location = os.getenv("GENAI_LOCATION")
-os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "peppy-linker-332510-c7733d076051.json"
+GOOGLE_CREDENTIALS_FILE = "peppy-linker-332510-c7733d076051.json"
 
+IMAGE_MIME_TYPES = {".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png"}
+DEFAULT_MODEL = os.getenv("GENAI_MODEL", "gemini-1.5-flash-002")
+GENERATION_SETTINGS = {"max_output_tokens": 8192, "temperature": 1, "top_p": 0.95, "response_mime_type": "application/json"}
 
-def extract_text_from_image(image_path, prompt, page_number):
+# ✅ Request scaffolding (model, config, safety settings) is built once per prompt/model/schema and reused
+# for every page. With context caching on, the web worker stores prompts long enough for Vertex to cache
+# (~32k tokens) server-side once per job, and every document process sends only its images.
+SCAFFOLD_CACHE_SIZE = int(os.getenv("SCAFFOLD_CACHE_SIZE", 32))
+CONTEXT_CACHE_ENABLED = os.getenv("CONTEXT_CACHE_ENABLED", "0") == "1"
+CONTEXT_CACHE_MIN_CHARS = int(os.getenv("CONTEXT_CACHE_MIN_CHARS", 32768 * 4))
+CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("CONTEXT_CACHE_TTL_SECONDS", 3600))
+
+_vertex = None
+_vertex_lock = threading.Lock()
+_safety_settings = None
+_scaffolds = OrderedDict()
+_scaffolds_lock = threading.Lock()
+_context_caches = {}  # (model_name, prompt) -> context cache name handed over by the web worker
+
+
+def get_vertex():
+    """
+    Imports and initializes the Vertex AI SDK on first use, once per process.
+    The SDK is slow to import, so web workers that never call the model never pay for it.
+    """
+    global _vertex
+    if _vertex is None:
+        with _vertex_lock:
+            if _vertex is None:
+                os.environ.setdefault("GOOGLE_APPLICATION_CREDENTIALS", GOOGLE_CREDENTIALS_FILE)
+                import vertexai
+                from vertexai import generative_models
+                vertexai.init(project=project, location=location)
+                _vertex = generative_models
+    return _vertex
+
+
+def _get_safety_settings(vertex):
+    global _safety_settings
+    if _safety_settings is None:
+        SafetySetting = vertex.SafetySetting
+        _safety_settings = [
+            SafetySetting(category=category, threshold=SafetySetting.HarmBlockThreshold.OFF)
+            for category in (
+                SafetySetting.HarmCategory.HARM_CATEGORY_HATE_SPEECH,
+                SafetySetting.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
+                SafetySetting.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
+                SafetySetting.HarmCategory.HARM_CATEGORY_HARASSMENT,
+            )
+        ]
+    return _safety_settings
+
+
+def create_context_cache(prompt, model_name=None):
+    """
+    Web worker: stores a long prompt in a Vertex context cache shared by every document of a job.
+    Returns the cache name, or None if the prompt is too short or caching isn't possible.
+    The job deletes it with delete_context_cache(); the TTL only covers a web worker that died.
+    """
+    if not CONTEXT_CACHE_ENABLED or len(prompt) < CONTEXT_CACHE_MIN_CHARS:
+        return None
+    model_name = model_name or DEFAULT_MODEL
+    try:
+        get_vertex()
+        from vertexai.preview import caching
+        cached_content = caching.CachedContent.create(
+            model_name=model_name, contents=[prompt], ttl=timedelta(seconds=CONTEXT_CACHE_TTL_SECONDS)
+        )
+        return cached_content.resource_name
+    except Exception as e:
+        print(f"⚠️ Context caching unavailable for {model_name}, sending the prompt with each page: {e}")
+        return None
+
+
+def delete_context_cache(cache_name):
+    try:
+        get_vertex()
+        from vertexai.preview import caching
+        caching.CachedContent(cache_name).delete()
+    except Exception as e:
+        print(f"⚠️ Could not delete context cache {cache_name}, it expires with its TTL: {e}")
+
+
+def use_context_cache(prompt, model_name, cache_name):
+    """ Document worker: builds this prompt's scaffolds on the job's context cache instead of the prompt text """
+    key = (model_name or DEFAULT_MODEL, prompt)
+    with _scaffolds_lock:
+        if _context_caches.get(key) == cache_name:
+            return
+        _context_caches[key] = cache_name
+        # Scaffolds built on an earlier job's cache would point at a deleted one
+        for scaffold_key in [scaffold_key for scaffold_key in _scaffolds if scaffold_key[:2] == key]:
+            del _scaffolds[scaffold_key]
+
+
+def get_scaffold(prompt, model_name=None, output_schema=None):
+    """
+    Returns the parts of a model request shared by every page with this prompt/model/schema:
+    {"model", "prompt_parts", "generation_config", "safety_settings"}. Built once per process.
+    """
+    model_name = model_name or DEFAULT_MODEL
+    key = (model_name, prompt, json.dumps(output_schema, sort_keys=True) if output_schema else None)
+    with _scaffolds_lock:
+        scaffold = _scaffolds.get(key)
+        if scaffold is not None:
+            _scaffolds.move_to_end(key)
+            return scaffold
+        cache_name = _context_caches.get(key[:2])
+
+    # ✅ Built without the lock: the SDK import can take seconds,
+    # and pages for other prompts shouldn't wait behind it
+    vertex = get_vertex()
+    settings = dict(GENERATION_SETTINGS)
+    if output_schema:
+        settings["response_schema"] = output_schema
+    scaffold = {
+        "key": key,
+        "model": vertex.GenerativeModel(model_name),
+        "prompt_parts": [prompt],
+        "generation_config": vertex.GenerationConfig(**settings),
+        "safety_settings": _get_safety_settings(vertex),
+        "context_cached": False
+    }
+    if cache_name:
+        from vertexai.preview.generative_models import GenerativeModel as PreviewModel
+        scaffold.update(model=PreviewModel.from_cached_content(cached_content=cache_name), prompt_parts=[],
+                        context_cached=True)
+
+    with _scaffolds_lock:
+        existing = _scaffolds.get(key)
+        if existing is not None:
+            scaffold = existing  # Another page built it first
+        else:
+            _scaffolds[key] = scaffold
+        _scaffolds.move_to_end(key)
+        while len(_scaffolds) > SCAFFOLD_CACHE_SIZE:
+            _scaffolds.popitem(last=False)
+        return scaffold
+
+
+def _drop_scaffold(scaffold):
+    """ Stops using a scaffold whose context cache failed; the next one sends the prompt text """
+    with _scaffolds_lock:
+        if _scaffolds.get(scaffold["key"]) is scaffold:
+            del _scaffolds[scaffold["key"]]
+        _context_caches.pop(scaffold["key"][:2], None)
+
+
+def extract_text_from_image(image_path, prompt, page_number, deadline=None, model_name=None, output_schema=None):
     max_retries = 10  # Maximum retry attempts
     backoff_factor = 2  # Exponential backoff (2, 4, 8, 16 sec)
     max_wait_time = 30  # **Maximum time allowed (30 seconds)**
     start_time = time.time()
+    if deadline is not None:
+        max_wait_time = min(max_wait_time, deadline - start_time)  # ✅ Never run past the job deadline
 
     extracted_data = []  # **Store extracted results**
     skipped_pages = []  # **Track skipped pages**
     timeout_reached = False  # **Flag if timeout occurs**
 
     try:
-        with open(image_path, "rb") as image_file:
-            encoded_image = base64.b64encode(image_file.read()).decode("utf-8")
+        with span("encode", page=page_number) as span_args:
+            with open(image_path, "rb") as image_file:
+                image_bytes = image_file.read()
+            span_args["bytes"] = len(image_bytes)
+
+            mime_type = IMAGE_MIME_TYPES.get(os.path.splitext(image_path)[1].lower(), "image/jpeg")
+            image_part = get_vertex().Part.from_data(mime_type=mime_type, data=image_bytes)
+        scaffold = get_scaffold(prompt, model_name, output_schema)
 
-        vertexai.init(project=project, location=location)
-        image_part = Part.from_data(mime_type="image/png", data=base64.b64decode(encoded_image))
-        model = GenerativeModel("gemini-1.5-flash-002")
-        chat = model.start_chat()
+        def send():
+            # Stateless call (no chat history), so a hedged duplicate can run alongside it
+            return scaffold["model"].generate_content([image_part] + scaffold["prompt_parts"],
+                                                      generation_config=scaffold["generation_config"],
+                                                      safety_settings=scaffold["safety_settings"])
 
         for attempt in range(max_retries):
-            elapsed_time = time.time() - start_time
+            remaining_time = max_wait_time - (time.time() - start_time)
 
-            if elapsed_time > max_wait_time:
+            if remaining_time <= 0:
                 print(f"Timeout reached ({max_wait_time} sec). Skipping Page {page_number}...")
-                skipped_pages.append(page_number)  # ✅ Mark this page as skipped
-                timeout_reached = True
-                break  # **Stop trying this page**
+                return {
+                    "extracted_data": extracted_data,
+                    "skipped_pages": [page_number],  # ✅ Mark this page as skipped
+                    "timeout": True
+                }
 
             try:
-                response = chat.send_message(
-                    [image_part, prompt],
-                    generation_config={"max_output_tokens": 8192, "temperature": 1, "top_p": 0.95, "response_mime_type": "application/json"},
-                    safety_settings = [
-                SafetySetting(
-                    category=SafetySetting.HarmCategory.HARM_CATEGORY_HATE_SPEECH,
-                    threshold=SafetySetting.HarmBlockThreshold.OFF
-                ),
-                SafetySetting(
-                    category=SafetySetting.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
-                    threshold=SafetySetting.HarmBlockThreshold.OFF
-                ),
-                SafetySetting(
-                    category=SafetySetting.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
-                    threshold=SafetySetting.HarmBlockThreshold.OFF
-                ),
-                SafetySetting(
-                    category=SafetySetting.HarmCategory.HARM_CATEGORY_HARASSMENT,
-                    threshold=SafetySetting.HarmBlockThreshold.OFF
-                ),
-            ]
-                )
-
-                response_text = response.text.strip().strip("```json").strip("```")
+                # ✅ Real per-call timeout, hedged once the call runs past the p95 latency
+                with span("model_call", page=page_number, attempt=attempt) as span_args:
+                    response, hedged = call_with_hedge(send, remaining_time)
+                    span_args["hedged"] = hedged
+                if hedged:
+                    print(f"Page {page_number} answered after hedging")
+
+                with span("parse", page=page_number):
+                    response_text = response.text.strip().strip("```json").strip("```")
+                    if response_text:
+                        extracted_data = json.loads(response_text)  # **Store results**
 
                 if response_text:
-                    extracted_data = json.loads(response_text)  # **Store results**
                     return {
                         "extracted_data": extracted_data,
                         "skipped_pages": skipped_pages,  # **Pages that were not processed**
                         "timeout": timeout_reached
                     }
 
+            except TimeoutError:
+                print(f"Timeout reached ({max_wait_time} sec). Skipping Page {page_number}...")
+                return {
+                    "extracted_data": extracted_data,
+                    "skipped_pages": [page_number],
+                    "timeout": True
+                }
+
             except Exception as e:
                 if "429" in str(e):
-                    wait_time = backoff_factor ** attempt  # Exponential wait (2, 4, 8 sec)
+                    # Exponential wait (1, 2, 4 sec), never past the page's time budget
+                    wait_time = min(backoff_factor ** attempt, max(max_wait_time - (time.time() - start_time), 0))
                     print(f"Rate limit hit (429), retrying in {wait_time} seconds...")
-                    time.sleep(wait_time)
+                    instant("retry", page=page_number, attempt=attempt, reason="429")
+                    with span("backoff", page=page_number, seconds=wait_time):
+                        time.sleep(wait_time)
                 else:
                     print(f"Error extracting text from Page {page_number}: {e}")
+                    if scaffold["context_cached"]:
+                        # ✅ e.g. the cache expired or its job ended; retry with the prompt text
+                        _drop_scaffold(scaffold)
+                        scaffold = get_scaffold(prompt, model_name, output_schema)
+                        continue
                     break  # **Skip this page if another error occurs**
 
         print(f"Max retries exceeded for Page {page_number}. Skipping...")
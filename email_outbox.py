@@ -0,0 +1,172 @@
+import os
+import smtplib
+import threading
+import time
+from email.message import EmailMessage
+from dotenv import load_dotenv
+from initialize_database import get_db
+from email_verification import connect_smtp, SMTP_USER
+
+load_dotenv()
+
+# ✅ Outbox sender settings
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 50))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", 2))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 8))
+OUTBOX_BACKOFF_BASE = int(os.getenv("OUTBOX_BACKOFF_BASE", 30))  # 30s, 60s, 120s, ...
+OUTBOX_BACKOFF_MAX = int(os.getenv("OUTBOX_BACKOFF_MAX", 3600))
+OUTBOX_CLAIM_SECONDS = int(os.getenv("OUTBOX_CLAIM_SECONDS", 600))  # Claimed emails come back after this if a sender dies
+SMTP_IDLE_TIMEOUT = int(os.getenv("SMTP_IDLE_TIMEOUT", 120))  # Drop the pooled session after this long unused
+
+_smtp = None
+_smtp_last_used = 0
+_sender_lock = threading.Lock()
+_sender_thread = None
+
+
+def enqueue_email(cursor, recipient, subject, body):
+    """
+    Queues an email using the caller's cursor, so it commits (or rolls back)
+    together with the rest of the caller's transaction.
+    """
+    cursor.execute("""
+        INSERT INTO email_outbox (recipient, subject, body)
+        VALUES (%s, %s, %s)
+    """, (recipient, subject, body))
+
+
+def _get_smtp():
+    """ Returns the pooled SMTP session, reconnecting if it went stale """
+    global _smtp, _smtp_last_used
+    if _smtp is not None:
+        idle = time.time() - _smtp_last_used
+        try:
+            if idle > SMTP_IDLE_TIMEOUT or _smtp.noop()[0] != 250:
+                raise smtplib.SMTPServerDisconnected("stale session")
+        except (smtplib.SMTPException, OSError):
+            _close_smtp()
+
+    if _smtp is None:
+        _smtp = connect_smtp()
+    _smtp_last_used = time.time()
+    return _smtp
+
+
+def _close_smtp():
+    global _smtp
+    if _smtp is not None:
+        try:
+            _smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+    _smtp = None
+
+
+def _backoff_seconds(attempts):
+    return min(OUTBOX_BACKOFF_BASE * (2 ** (attempts - 1)), OUTBOX_BACKOFF_MAX)
+
+
+def _claim_batch(conn):
+    """
+    Claims due emails and commits right away: pushing next_attempt_at forward works as a lease,
+    so no row locks are held while sending and a crashed sender's emails are retried later.
+    """
+    with conn.cursor() as cursor:
+        # ✅ SKIP LOCKED lets several senders share the outbox without double-sending
+        cursor.execute("""
+            UPDATE email_outbox
+            SET attempts = attempts + 1, next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+            WHERE id IN (
+                SELECT id FROM email_outbox
+                WHERE status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, recipient, subject, body, attempts
+        """, (OUTBOX_CLAIM_SECONDS, OUTBOX_BATCH_SIZE))
+        rows = sorted(cursor.fetchall())
+    conn.commit()
+    return rows
+
+
+def send_pending_batch():
+    """ Sends one batch of due emails over the pooled session, committing after each. Returns how many were sent. """
+    sent = 0
+    conn = get_db()
+    try:
+        for email_id, recipient, subject, body, attempts in _claim_batch(conn):
+            msg = EmailMessage()
+            msg["Subject"] = subject
+            msg["From"] = SMTP_USER
+            msg["To"] = recipient
+            msg.set_content(body)
+
+            with conn.cursor() as cursor:
+                try:
+                    _get_smtp().send_message(msg)
+                    cursor.execute("""
+                        UPDATE email_outbox
+                        SET status = 'sent', sent_at = CURRENT_TIMESTAMP, last_error = NULL
+                        WHERE id = %s
+                    """, (email_id,))
+                    sent += 1
+                except Exception as e:
+                    print(f"🚨 Error sending email {email_id} to {recipient}: {e}")
+                    if isinstance(e, (smtplib.SMTPServerDisconnected, OSError)):
+                        _close_smtp()  # ✅ Reconnect on the next message
+
+                    permanent = isinstance(e, smtplib.SMTPRecipientsRefused)
+                    if permanent or attempts >= OUTBOX_MAX_ATTEMPTS:
+                        cursor.execute("""
+                            UPDATE email_outbox SET status = 'failed', last_error = %s
+                            WHERE id = %s
+                        """, (str(e), email_id))
+                    else:
+                        cursor.execute("""
+                            UPDATE email_outbox
+                            SET last_error = %s, next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+                            WHERE id = %s
+                        """, (str(e), _backoff_seconds(attempts), email_id))
+            conn.commit()  # ✅ A later failure can't undo the record of an email already delivered
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    if sent:
+        print(f"✅ Outbox sent {sent} email(s)")
+    return sent
+
+
+def run_sender(stop_event=None):
+    """ Drains the outbox forever, keeping one SMTP session open between batches """
+    while stop_event is None or not stop_event.is_set():
+        try:
+            sent = send_pending_batch()
+        except Exception as e:
+            print(f"🚨 Outbox sender error: {e}")
+            sent = 0
+
+        # ✅ A full batch means there is likely more waiting, so go again right away
+        if sent < OUTBOX_BATCH_SIZE:
+            if _smtp is not None and time.time() - _smtp_last_used > SMTP_IDLE_TIMEOUT:
+                _close_smtp()
+            time.sleep(OUTBOX_POLL_INTERVAL)
+
+    _close_smtp()
+
+
+def start_sender():
+    """ Starts the background sender thread once per process """
+    global _sender_thread
+    with _sender_lock:
+        if _sender_thread is None or not _sender_thread.is_alive():
+            _sender_thread = threading.Thread(target=run_sender, name="email-outbox", daemon=True)
+            _sender_thread.start()
+
+
+if __name__ == "__main__":
+    # Standalone sender: python email_outbox.py
+    run_sender()
@@ -11,14 +11,13 @@ SMTP_PORT = int(os.getenv("SMTP_PORT", 587))
 SMTP_USER = os.getenv("SMTP_USER")
 SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
 
-def send_email_verification(email, verification_link):
-    """ Sends a verification email to the user """
-    try:
-        msg = EmailMessage()
-        msg["Subject"] = "Verify Your Email - SwiftExtract AI"
-        msg["From"] = SMTP_USER
-        msg["To"] = email
-        msg.set_content(f"""
+SMTP_USE_TLS = os.getenv("SMTP_USE_TLS", "1") == "1"  # Set to 0 for a local debugging server
+
+
+def build_verification_email(verification_link):
+    """ Returns the (subject, body) of the verification email """
+    subject = "Verify Your Email - SwiftExtract AI"
+    body = f"""
         Dear user,
 
         Click the link below to verify your email:
@@ -29,23 +28,36 @@ def send_email_verification(email, verification_link):
 
         Best,
         SwiftExtract AI
-        """)
+        """
+    return subject, body
 
-        print("🔹 Connecting to SMTP server...")
-        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=10)  # Add timeout
 
-        print("🔹 Identifying to server...")
-        server.ehlo()  # Must run before starttls()
+def connect_smtp():
+    """ Opens an authenticated SMTP session """
+    print("🔹 Connecting to SMTP server...")
+    server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=10)  # Add timeout
+    server.ehlo()  # Must run before starttls()
 
-        print("🔹 Starting TLS encryption...")
+    if SMTP_USE_TLS:
         server.starttls()
-
-        print("🔹 Identifying again after TLS...")
         server.ehlo()  # Must run again after starttls()
 
-        print("🔹 Logging into SMTP server...")
+    if SMTP_USER and SMTP_PASSWORD:
         server.login(SMTP_USER, SMTP_PASSWORD)
+    return server
+
+
+def send_email_verification(email, verification_link):
+    """ Sends a verification email to the user right away (prefer email_outbox.enqueue_email) """
+    try:
+        subject, body = build_verification_email(verification_link)
+        msg = EmailMessage()
+        msg["Subject"] = subject
+        msg["From"] = SMTP_USER
+        msg["To"] = email
+        msg.set_content(body)
 
+        server = connect_smtp()
         print("🔹 Sending email...")
         server.send_message(msg)  # Send email
 
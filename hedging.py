@@ -0,0 +1,187 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# ✅ Hedged request settings
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "1") == "1"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", 0.95))
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", 10))  # Used until enough latencies are seen
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", 20))
+HEDGE_MAX_RATIO = float(os.getenv("HEDGE_MAX_RATIO", 0.1))  # At most ~10% extra calls
+HEDGE_BURST = float(os.getenv("HEDGE_BURST", 3))
+MODEL_CALL_MAX_OUTSTANDING = int(os.getenv("MODEL_CALL_MAX_OUTSTANDING", 16))  # No hedging beyond this many live calls
+
+
+class LatencyTracker:
+    """ Rolling window of successful call latencies """
+
+    def __init__(self, window=200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, fraction):
+        with self._lock:
+            if len(self._samples) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+class HedgeBudget:
+    """
+    Token bucket: every primary call earns HEDGE_MAX_RATIO of a hedge, capped at HEDGE_BURST.
+    The web worker's scheduler keeps one that starts full; a process-local one (distributed
+    workers) starts empty, so every worker process on a node doesn't get its own burst.
+    """
+
+    def __init__(self, ratio=HEDGE_MAX_RATIO, burst=HEDGE_BURST, tokens=0.0):
+        self.ratio = ratio
+        self.burst = burst
+        self._tokens = tokens
+        self._lock = threading.Lock()
+
+    def earn(self, calls=1):
+        with self._lock:
+            self._tokens = min(self._tokens + self.ratio * calls, self.burst)
+
+    def refund(self):
+        """ Returns a token reserved for a page that didn't need its hedge """
+        with self._lock:
+            self._tokens = min(self._tokens + 1, self.burst)
+
+    def try_spend(self):
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+
+latency_tracker = LatencyTracker()
+hedge_budget = HedgeBudget()
+_outstanding = 0
+_outstanding_lock = threading.Lock()
+_local = threading.local()
+
+
+@contextmanager
+def page_hedging(grant):
+    """
+    Applies a scheduler grant (see scheduler.PageGate) to the model calls this thread makes for one
+    page: its hedge delay, and whether a hedge token was reserved for the page. Yields the report
+    to hand back with PageGate.release(), or None without a grant (process-local tracking then).
+    """
+    if not isinstance(grant, dict):
+        yield None
+        return
+    _local.plan = {"hedge_delay": grant["hedge_delay"], "hedge_reserved": grant["hedge_reserved"],
+                   "hedged": False, "calls": 0, "latencies": []}
+    try:
+        yield _local.plan
+    finally:
+        _local.plan = None
+
+
+def outstanding_calls():
+    """ Calls still running in this process, including abandoned ones """
+    with _outstanding_lock:
+        return _outstanding
+
+
+def _start_call(fn, plan=None):
+    """
+    Runs fn() on its own daemon thread. A call that hangs or loses a hedge race only ties up
+    its own thread, never a slot that a healthy call is queued behind.
+    """
+    global _outstanding
+    future = Future()
+    future.set_running_or_notify_cancel()
+
+    def run():
+        global _outstanding
+        start = time.time()
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            latency_tracker.record(time.time() - start)
+            if plan is not None:
+                plan["latencies"].append(time.time() - start)  # ✅ Reported to the scheduler's tracker
+            future.set_result(result)
+        finally:
+            with _outstanding_lock:
+                _outstanding -= 1
+
+    with _outstanding_lock:
+        _outstanding += 1
+    threading.Thread(target=run, daemon=True, name="model-call").start()
+    return future
+
+
+def hedge_delay():
+    """ How long to wait for the primary call before hedging: the running p95 latency """
+    return latency_tracker.percentile(HEDGE_PERCENTILE) or HEDGE_DEFAULT_DELAY
+
+
+def _may_hedge(plan):
+    if plan is None:
+        return hedge_budget.try_spend()
+    if plan["hedge_reserved"] and not plan["hedged"]:
+        plan["hedged"] = True  # One hedge per reserved token
+        return True
+    return False
+
+
+def call_with_hedge(fn, timeout):
+    """
+    Runs fn() with a real timeout. If it hasn't answered by the running p95 latency,
+    a second identical call is sent (budget permitting) and whichever answers first wins.
+    The loser keeps running until it returns; its result is discarded. Returns (result, hedged).
+    Raises TimeoutError when nothing answers within `timeout`, or the call's own exception.
+
+    Inside page_hedging(), the delay and budget come from the web worker's scheduler, which
+    has seen every document's calls; otherwise from this process's own tracker and budget.
+    """
+    deadline = time.time() + timeout
+    plan = getattr(_local, "plan", None)
+    if plan is None:
+        hedge_budget.earn()
+    else:
+        plan["calls"] += 1
+    pending = {_start_call(fn, plan)}
+    hedged = False
+
+    if HEDGE_ENABLED:
+        first_wait = min(plan["hedge_delay"] if plan is not None else hedge_delay(), timeout)
+        done, _ = wait(pending, timeout=first_wait)
+        if (not done and time.time() < deadline and outstanding_calls() < MODEL_CALL_MAX_OUTSTANDING
+                and _may_hedge(plan)):
+            print(f"⏱️ Call slower than {first_wait:.1f}s, sending hedged request")
+            pending.add(_start_call(fn, plan))
+            hedged = True
+
+    error = None
+    while pending:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result(), hedged  # ✅ The other call's result, if any, is ignored
+            error = future.exception()
+
+    if error is not None:
+        raise error
+    raise TimeoutError(f"Model call exceeded {timeout:.1f}s")
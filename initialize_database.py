@@ -1,7 +1,6 @@
 import os
 import psycopg2
 import psycopg2.extras
-import bcrypt
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -33,64 +32,9 @@ def get_db():
 
 # ✅ Initialize PostgreSQL Database
 def init_db():
+    """ Brings the schema up to date. Run it once per deploy (python migrations.py), not per worker. """
+    from migrations import run_migrations
     try:
-        with get_db() as conn:
-            with conn.cursor() as cursor:
-                # ✅ Create users table
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS users (
-                        id SERIAL PRIMARY KEY,
-                        username TEXT UNIQUE NOT NULL,
-                        email TEXT UNIQUE NOT NULL,
-                        password TEXT NOT NULL,
-                        is_verified BOOLEAN DEFAULT FALSE,
-                        created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
-                    );
-                """)
-
-                # ✅ Create extraction_history table
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS extraction_history (
-                        id SERIAL PRIMARY KEY,
-                        username TEXT NOT NULL REFERENCES users(username) ON DELETE CASCADE,
-                        document_name TEXT NOT NULL,
-                        total_rows INTEGER NOT NULL,
-                        total_time REAL NOT NULL,
-                        timestamp TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
-                    );
-                """)
-
-                # ✅ Create removed_users table
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS removed_users (
-                        id SERIAL PRIMARY KEY,
-                        username TEXT UNIQUE NOT NULL REFERENCES users(username) ON DELETE CASCADE,
-                        removed_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
-                    );
-                """)
-
-                # ✅ Create email_verifications table
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS email_verifications (
-                        email TEXT PRIMARY KEY REFERENCES users(email) ON DELETE CASCADE,
-                        token TEXT UNIQUE NOT NULL,
-                        expires_at TIMESTAMPTZ NOT NULL
-                    );
-                """)
-
-                conn.commit()
-
-                # ✅ Ensure admin user exists
-                cursor.execute("SELECT EXISTS(SELECT 1 FROM users WHERE username = 'admin')")
-                admin_exists = cursor.fetchone()[0]
-
-                if not admin_exists:
-                    hashed_password = bcrypt.hashpw("admin123".encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
-                    cursor.execute("INSERT INTO users (username, email, password, is_verified) VALUES (%s, %s, %s, TRUE)", 
-                                   ("admin", "admin@example.com", hashed_password))
-                    conn.commit()
-
-                print("✅ PostgreSQL Database initialized successfully!")
-
+        run_migrations()
     except Exception as e:
         print(f"🚨 Error initializing database: {e}")
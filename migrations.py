@@ -0,0 +1,208 @@
+import bcrypt
+from initialize_database import get_db
+
+# Arbitrary key for pg_advisory_lock, so only one process migrates at a time
+MIGRATION_LOCK_KEY = 72_410_331
+
+
+def _seed_admin(cursor):
+    cursor.execute("SELECT EXISTS(SELECT 1 FROM users WHERE username = 'admin')")
+    if not cursor.fetchone()[0]:
+        hashed_password = bcrypt.hashpw("admin123".encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+        cursor.execute("INSERT INTO users (username, email, password, is_verified) VALUES (%s, %s, %s, TRUE)",
+                       ("admin", "admin@example.com", hashed_password))
+
+
+# ✅ Ordered schema history. Never edit an applied entry, append a new one instead.
+# Each entry is (version, description, SQL string or callable taking a cursor).
+MIGRATIONS = [
+    (1, "create core tables", """
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            username TEXT UNIQUE NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            is_verified BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+        );
+
+        CREATE TABLE IF NOT EXISTS extraction_history (
+            id SERIAL PRIMARY KEY,
+            username TEXT NOT NULL REFERENCES users(username) ON DELETE CASCADE,
+            document_name TEXT NOT NULL,
+            total_rows INTEGER NOT NULL,
+            total_time REAL NOT NULL,
+            timestamp TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+        );
+
+        CREATE TABLE IF NOT EXISTS removed_users (
+            id SERIAL PRIMARY KEY,
+            username TEXT UNIQUE NOT NULL REFERENCES users(username) ON DELETE CASCADE,
+            removed_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+        );
+
+        CREATE TABLE IF NOT EXISTS email_verifications (
+            email TEXT PRIMARY KEY REFERENCES users(email) ON DELETE CASCADE,
+            token TEXT UNIQUE NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL
+        );
+    """),
+    (2, "seed admin user", _seed_admin),
+    (3, "create email_outbox", """
+        CREATE TABLE IF NOT EXISTS email_outbox (
+            id SERIAL PRIMARY KEY,
+            recipient TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            body TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            last_error TEXT,
+            created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+            sent_at TIMESTAMPTZ
+        );
+        CREATE INDEX IF NOT EXISTS email_outbox_due_idx
+        ON email_outbox (next_attempt_at) WHERE status = 'pending';
+    """),
+    (4, "create sessions", """
+        CREATE TABLE IF NOT EXISTS sessions (
+            sid TEXT PRIMARY KEY,
+            data JSONB NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS sessions_expires_idx ON sessions (expires_at);
+    """),
+    (5, "add users.share_weight for fair-share scheduling", """
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS share_weight REAL NOT NULL DEFAULT 1;
+    """),
+    (6, "create distributed page work queue", """
+        CREATE TABLE IF NOT EXISTS job_documents (
+            sha256 TEXT PRIMARY KEY,
+            content BYTEA NOT NULL,
+            created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+        );
+
+        CREATE TABLE IF NOT EXISTS page_tasks (
+            id BIGSERIAL PRIMARY KEY,
+            job_id TEXT NOT NULL,
+            username TEXT NOT NULL,
+            document_name TEXT NOT NULL,
+            document_sha256 TEXT NOT NULL REFERENCES job_documents(sha256),
+            prompt TEXT NOT NULL,
+            first_page INTEGER NOT NULL,
+            last_page INTEGER NOT NULL,
+            total_pages INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            lease_owner TEXT,
+            lease_expires_at TIMESTAMPTZ,
+            pages_done INTEGER NOT NULL DEFAULT 0,
+            extracted_data JSONB,
+            skipped_pages JSONB,
+            total_time REAL,
+            error TEXT,
+            created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS page_tasks_queued_idx ON page_tasks (id) WHERE status = 'queued';
+        CREATE INDEX IF NOT EXISTS page_tasks_lease_idx ON page_tasks (lease_expires_at) WHERE status = 'running';
+        CREATE INDEX IF NOT EXISTS page_tasks_job_idx ON page_tasks (job_id);
+    """),
+    (7, "create extracted_rows partitioned by date", """
+        CREATE TABLE IF NOT EXISTS extracted_rows (
+            id BIGSERIAL,
+            job_id TEXT NOT NULL,
+            username TEXT NOT NULL,
+            document_name TEXT NOT NULL,
+            page_number INTEGER NOT NULL,
+            payload JSONB NOT NULL,
+            extracted_on DATE NOT NULL DEFAULT CURRENT_DATE,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, extracted_on)
+        ) PARTITION BY RANGE (extracted_on);
+        CREATE TABLE IF NOT EXISTS extracted_rows_default PARTITION OF extracted_rows DEFAULT;
+        CREATE INDEX IF NOT EXISTS extracted_rows_job_idx ON extracted_rows (job_id, document_name, page_number);
+        CREATE INDEX IF NOT EXISTS extracted_rows_user_idx ON extracted_rows (username, extracted_on);
+    """),
+    (8, "add job deadlines to page_tasks", """
+        ALTER TABLE page_tasks ADD COLUMN IF NOT EXISTS deadline_at TIMESTAMPTZ;
+        ALTER TABLE page_tasks ADD COLUMN IF NOT EXISTS unprocessed_pages JSONB;
+    """),
+    (9, "add regions of interest to page_tasks", """
+        ALTER TABLE page_tasks ADD COLUMN IF NOT EXISTS regions JSONB;
+    """),
+    (10, "add per-job tracing to page_tasks", """
+        ALTER TABLE page_tasks ADD COLUMN IF NOT EXISTS trace_mode TEXT;
+        ALTER TABLE page_tasks ADD COLUMN IF NOT EXISTS trace_events JSONB;
+    """),
+    (11, "create templates", """
+        CREATE TABLE IF NOT EXISTS templates (
+            template_id TEXT PRIMARY KEY,
+            prompt TEXT NOT NULL,
+            output_schema JSONB,
+            model TEXT NOT NULL,
+            image_settings JSONB NOT NULL DEFAULT '{}',
+            regions JSONB,
+            version INTEGER NOT NULL DEFAULT 1,
+            updated_by TEXT,
+            updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+        );
+        ALTER TABLE page_tasks ADD COLUMN IF NOT EXISTS template_id TEXT;
+    """),
+    (12, "record deadline stops on page_tasks", """
+        ALTER TABLE page_tasks ADD COLUMN IF NOT EXISTS stopped_for_deadline BOOLEAN NOT NULL DEFAULT FALSE;
+    """),
+    (13, "share a job's context cache through page_tasks", """
+        ALTER TABLE page_tasks ADD COLUMN IF NOT EXISTS context_cache TEXT;
+    """),
+]
+
+
+def run_migrations():
+    """ Applies every pending migration, each in its own transaction. Returns the applied versions. """
+    applied = []
+    conn = get_db()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+            try:
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version INTEGER PRIMARY KEY,
+                        description TEXT NOT NULL,
+                        applied_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+                    );
+                """)
+                conn.commit()
+
+                cursor.execute("SELECT version FROM schema_migrations")
+                done = {row[0] for row in cursor.fetchall()}
+
+                for version, description, step in MIGRATIONS:
+                    if version in done:
+                        continue
+                    print(f"🔹 Applying migration {version}: {description}")
+                    if callable(step):
+                        step(cursor)
+                    else:
+                        cursor.execute(step)
+                    cursor.execute("INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                                   (version, description))
+                    conn.commit()
+                    applied.append(version)
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
+                conn.commit()
+    finally:
+        conn.close()
+
+    print(f"✅ Database schema up to date ({len(applied)} migration(s) applied)")
+    return applied
+
+
+if __name__ == "__main__":
+    # Run once per deploy, before starting the web workers: python migrations.py
+    run_migrations()
@@ -1,11 +1,28 @@
-from pdf2image import convert_from_path
 import tempfile
+import math
 import os
 import time
-from data_extraction import extract_text_from_image
+import threading
+import queue as queue_module
+from data_extraction import extract_text_from_image, use_context_cache
+from hedging import page_hedging
+from rasterizer import rasterize_pages, PageBuffer
+from row_store import RowWriter
+from tracing import span, record, start_trace, stop_trace
 import psycopg2
 import psycopg2.extras
 
+# ✅ Pages rasterized ahead of the model stage. The rasterizer lanes wait before starting a chunk
+# that would put more than this many in waiting, so a slow model stage caps the page images on disk.
+# Parallel lanes raise it to one chunk each, up to RASTER_MAX_PREFETCH_PAGES (see rasterizer.py).
+RASTER_PREFETCH_PAGES = int(os.getenv("RASTER_PREFETCH_PAGES", 2))
+
+# ✅ Deadline handling: pages in flight per document when a deadline needs them, the page time
+# assumed when planning for it, and the least time left worth starting a page with
+DEADLINE_MAX_PAGE_PARALLELISM = int(os.getenv("DEADLINE_MAX_PAGE_PARALLELISM", 4))
+ESTIMATED_PAGE_SECONDS = float(os.getenv("DEFAULT_PAGE_SECONDS", 5))
+MIN_PAGE_SECONDS = float(os.getenv("MIN_PAGE_SECONDS", 3))
+
 # ✅ PostgreSQL Configuration
 DB_HOST = os.getenv("POSTGRES_HOST")
 DB_NAME = os.getenv("POSTGRES_DB")
@@ -33,63 +50,237 @@ def save_extraction_history(username, document_name, total_rows, total_time):
     conn.commit()
     conn.close()
 
-def process_pdf(pdf_path, prompt, username, queue, total_pages_global):
-    document_name = os.path.basename(pdf_path)
-    print(f"Started processing: {document_name}", flush=True)
+def _page_parallelism(page_count, deadline):
+    """ One page at a time normally; more when the pages can't fit the deadline one by one """
+    if deadline is None:
+        return 1
+    remaining_time = max(deadline - time.time(), 1)
+    needed = math.ceil(page_count * ESTIMATED_PAGE_SECONDS / remaining_time)
+    return max(1, min(needed, DEADLINE_MAX_PAGE_PARALLELISM, page_count))
+
+
+def extract_page(image_path, prompt, page_number, regions=None, temp_dir=None, deadline=None, template=None):
+    """
+    Extracts one page image. With regions, only the cropped regions (and their tiles) are sent,
+    each with its own prompt, and the results are merged and tagged with the region name.
+    Crops not sent before the deadline mark the page skipped.
+    A template supplies the model and output schema.
+    """
+    template = template or {}
+    model_options = {"model_name": template.get("model"), "output_schema": template.get("output_schema")}
+    if not regions:
+        return extract_text_from_image(image_path, prompt, page_number, deadline=deadline, **model_options)
+
+    from regions import crop_regions
+
+    extracted_data, skipped_pages = [], set()
+    with span("crop", page=page_number, regions=len(regions)):
+        crops = crop_regions(image_path, regions, temp_dir, page_number)
+    for index, (region, tile_index, crop_path) in enumerate(crops):
+        # ✅ Each crop is a model call of its own, so each one is checked against the deadline
+        if deadline is not None and deadline - time.time() < MIN_PAGE_SECONDS:
+            for _, _, unsent_path in crops[index:]:
+                os.remove(unsent_path)
+            skipped_pages.add(page_number)
+            return {"extracted_data": extracted_data, "skipped_pages": sorted(skipped_pages), "timeout": True}
+        try:
+            result = extract_text_from_image(crop_path, region["prompt"] or prompt, page_number, deadline=deadline,
+                                             **model_options)
+        finally:
+            os.remove(crop_path)
+        items = result["extracted_data"]
+        if isinstance(items, dict):
+            items = [items]
+        for item in items or []:
+            if isinstance(item, dict):
+                item["region"] = region["name"]
+                if region["tile"] != [1, 1]:
+                    item["region_tile"] = tile_index
+            extracted_data.append(item)
+        skipped_pages.update(result["skipped_pages"])
+    return {"extracted_data": extracted_data, "skipped_pages": sorted(skipped_pages), "timeout": False}
+
+
+def process_page_range(pdf_path, document_name, prompt, first_page, last_page, page_gate=None, on_page=None,
+                       row_sink=None, deadline=None, regions=None, template=None):
+    """
+    Rasterizes and extracts pages first_page..last_page of one PDF.
+    Calls on_page(page_number, render_seconds) after each page, hands each page's rows to row_sink.add()
+    and returns (extracted_rows, skipped_pages, unprocessed_pages, stopped_for_deadline).
+
+    With a deadline (epoch seconds), pages are worked on in parallel when needed to finish
+    in time, no page is started that can't finish before it, and every page not reached
+    is returned in unprocessed_pages. stopped_for_deadline tells that stop apart from others,
+    since it happens up to MIN_PAGE_SECONDS before the deadline itself.
+
+    With regions (see regions.parse_regions), only those parts of each page are sent to the model.
+    A template (see template_registry) sets the model, output schema and image settings.
+    """
+    results = {}
+    skipped_pages = []
+    processed = set()
+    lock = threading.Lock()
+    parallelism = _page_parallelism(last_page - first_page + 1, deadline)
 
     with tempfile.TemporaryDirectory() as temp_dir:
+        stop_event = threading.Event()
+        deadline_stop = threading.Event()
+        page_buffer = PageBuffer(max(RASTER_PREFETCH_PAGES, parallelism))
+        rasterizer = threading.Thread(target=rasterize_pages, args=(pdf_path, first_page, last_page, temp_dir, page_buffer, stop_event),
+                                      kwargs={"image_settings": (template or {}).get("image_settings")},
+                                      daemon=True, name="rasterizer")
+        rasterizer.start()
+        errors = []
+
+        def work_pages():
+            waiting_since = time.time()
+            while not stop_event.is_set():
+                try:
+                    next_page = page_buffer.get(timeout=1)
+                except queue_module.Empty:
+                    continue
+                if next_page is None:
+                    page_buffer.put(None)  # Let the other workers see the end too
+                    return
+                if isinstance(next_page, Exception):
+                    errors.append(next_page)
+                    stop_event.set()
+                    return
+                page_number, image_path, render_seconds = next_page
+                record("wait", waiting_since, time.time(), page=page_number, on="rasterizer")
+
+                # ✅ Don't start a page that can't finish before the deadline
+                if deadline is not None and deadline - time.time() < MIN_PAGE_SECONDS:
+                    os.remove(image_path)
+                    deadline_stop.set()
+                    stop_event.set()
+                    return
+
+                # ✅ Extract text, once the scheduler grants this page a slot
+                grant = None
+                if page_gate is not None:
+                    with span("wait", page=page_number, on="scheduler"):
+                        grant = page_gate.acquire()
+                page_start = time.time()
+                hedge_report = None
+                try:
+                    with span("page", page=page_number, document=document_name), page_hedging(grant) as hedge_report:
+                        extraction_result = extract_page(image_path, prompt, page_number, regions=regions,
+                                                         temp_dir=temp_dir, deadline=deadline, template=template)
+                finally:
+                    if page_gate is not None:
+                        page_gate.release(time.time() - page_start, hedge_report)
+                    os.remove(image_path)  # ✅ Only the prefetched pages stay on disk
+
+                with lock:
+                    processed.add(page_number)
+                    if extraction_result["extracted_data"]:
+                        for item in extraction_result["extracted_data"]:
+                            item["page_number"] = page_number
+                            item["document_name"] = document_name
+                        results[page_number] = extraction_result["extracted_data"]
+                        if row_sink is not None:
+                            row_sink.add(document_name, page_number, extraction_result["extracted_data"])
+
+                    if extraction_result["skipped_pages"]:
+                        skipped_pages.extend(extraction_result["skipped_pages"])
+
+                    if on_page is not None:
+                        on_page(page_number, render_seconds)
+                waiting_since = time.time()
+
+        def work():
+            # ✅ A failing page thread stops the range and its error is raised to the caller,
+            # instead of the remaining pages being reported as unprocessed
+            try:
+                work_pages()
+            except Exception as e:
+                errors.append(e)
+                stop_event.set()
+
+        workers = [threading.Thread(target=work, daemon=True, name=f"page-{index}") for index in range(parallelism)]
         try:
-            images = convert_from_path(pdf_path, output_folder=temp_dir, fmt="jpeg")
-            total_pages = len(images)  
-            all_data = []
-            skipped_pages = []
-            start_time = time.time()
-
-            for idx, image in enumerate(images):
-                page_number = idx + 1
-                image_path = os.path.join(temp_dir, f"page_{page_number}.jpg")
-                image.save(image_path, "JPEG")
-
-                # ✅ Extract text
-                extraction_result = extract_text_from_image(image_path, prompt, page_number)
-
-                if extraction_result["extracted_data"]:
-                    for item in extraction_result["extracted_data"]:
-                        item["page_number"] = page_number
-                        item["document_name"] = document_name
-                        all_data.append(item)
-
-                if extraction_result["skipped_pages"]:
-                    skipped_pages.extend(extraction_result["skipped_pages"])
-
-                # ✅ Per-document progress
-                doc_progress = round((page_number / total_pages) * 100, 2)
-
-                # ✅ Global progress update
-                queue.put({
-                    "document_name": document_name,
-                    "page_number": page_number,
-                    "total_pages": total_pages,
-                    "progress": doc_progress,
-                    "total_pages_global": total_pages_global,
-                    "current_page_processed": 1  # ✅ Used for dynamic total progress
-                })
-
-            total_time = round(time.time() - start_time, 2)
-            total_rows_extracted = len(all_data)
-            avg_time_per_field = round(total_time / total_rows_extracted, 2) if total_rows_extracted > 0 else 0
-            save_extraction_history(username, document_name, total_rows_extracted, total_time)
-            # ✅ Send final extracted data
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        finally:
+            stop_event.set()
+
+        if errors:
+            raise errors[0]
+
+    all_data = [item for page_number in sorted(results) for item in results[page_number]]
+    unprocessed_pages = [page for page in range(first_page, last_page + 1) if page not in processed]
+    return all_data, sorted(skipped_pages), unprocessed_pages, deadline_stop.is_set()
+
+
+def process_pdf(pdf_path, prompt, username, queue, total_pages_global, page_gate=None, job_id=None, deadline=None,
+                regions=None, trace_mode=None, trace_dir=None, template=None, context_cache=None):
+    document_name = os.path.basename(pdf_path)
+    print(f"Started processing: {document_name}", flush=True)
+    if trace_mode:
+        start_trace(trace_dir, profile=trace_mode == "profile", label=document_name)
+    if context_cache:
+        use_context_cache(prompt, (template or {}).get("model"), context_cache)  # ✅ Created once by the web worker
+
+    from pdf2image import pdfinfo_from_path
+
+    try:
+        total_pages = int(pdfinfo_from_path(pdf_path)["Pages"])
+        start_time = time.time()
+        pages_done = 0
+
+        def report_progress(page_number, render_seconds):
+            nonlocal pages_done
+            pages_done += 1  # Pages may finish out of order when run in parallel
+
+            # ✅ Per-document progress
+            doc_progress = round((pages_done / total_pages) * 100, 2)
+
+            # ✅ Global progress update
             queue.put({
-                "completed": True,
                 "document_name": document_name,
-                "total_time": total_time,
-                "total_rows_extracted": total_rows_extracted,
-                "avg_time_per_row": avg_time_per_field,
-                "skipped_pages": skipped_pages,
-                "extracted_data": all_data
+                "page_number": page_number,
+                "total_pages": total_pages,
+                "progress": doc_progress,
+                "total_pages_global": total_pages_global,
+                "render_ms": round(render_seconds * 1000),
+                "current_page_processed": 1  # ✅ Used for dynamic total progress
             })
 
-        except Exception as e:
-            print(f"Error processing {document_name}: {str(e)}", flush=True)
-            queue.put({"error": str(e)})
\ No newline at end of file
+        row_writer = RowWriter(job_id, username) if job_id else None
+        try:
+            all_data, skipped_pages, unprocessed_pages, stopped_for_deadline = process_page_range(
+                pdf_path, document_name, prompt, 1, total_pages,
+                page_gate=page_gate, on_page=report_progress, row_sink=row_writer, deadline=deadline,
+                regions=regions, template=template
+            )
+        finally:
+            if row_writer is not None:
+                row_writer.close()  # ✅ Flush the last partial COPY batch
+
+        total_time = round(time.time() - start_time, 2)
+        total_rows_extracted = len(all_data)
+        avg_time_per_field = round(total_time / total_rows_extracted, 2) if total_rows_extracted > 0 else 0
+        save_extraction_history(username, document_name, total_rows_extracted, total_time)
+        # ✅ Send final extracted data
+        queue.put({
+            "completed": True,
+            "document_name": document_name,
+            "total_pages": total_pages,
+            "total_time": total_time,
+            "total_rows_extracted": total_rows_extracted,
+            "avg_time_per_row": avg_time_per_field,
+            "skipped_pages": skipped_pages,
+            "unprocessed_pages": unprocessed_pages,  # ✅ Not reached before the job deadline
+            "stopped_for_deadline": stopped_for_deadline,
+            "extracted_data": all_data
+        })
+
+    except Exception as e:
+        print(f"Error processing {document_name}: {str(e)}", flush=True)
+        queue.put({"error": str(e), "completed": True, "document_name": document_name})
+
+    finally:
+        stop_trace()  # ✅ Flushed before the process exits, the web worker merges it after join()
\ No newline at end of file
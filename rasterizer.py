@@ -0,0 +1,187 @@
+import math
+import os
+import tempfile
+import threading
+import time
+import queue as queue_module
+from dotenv import load_dotenv
+from tracing import span
+
+load_dotenv()
+
+# ✅ Rasterization settings. Pages are rendered by several pdftoppm processes at once, each on its own
+# chunks of pages, writing final JPEGs straight into the job's temp folder (no PIL re-save).
+# The node's cores are split between the documents being rasterized at the same time.
+RASTER_DPI = int(os.getenv("RASTER_DPI", 200))
+RASTER_JPEG_QUALITY = int(os.getenv("RASTER_JPEG_QUALITY", 90))
+RASTER_MAX_THREADS = int(os.getenv("RASTER_MAX_THREADS", 8))
+RASTER_MIN_PAGES_PER_THREAD = int(os.getenv("RASTER_MIN_PAGES_PER_THREAD", 4))  # Small PDFs aren't worth splitting
+RASTER_CHUNK_PAGES = int(os.getenv("RASTER_CHUNK_PAGES", 4))
+RASTER_MAX_PREFETCH_PAGES = int(os.getenv("RASTER_MAX_PREFETCH_PAGES", 32))  # Rendered pages on disk per document, at most
+RASTER_STATE_DIR = os.getenv("RASTER_STATE_DIR", os.path.join(tempfile.gettempdir(), "swiftextract_raster"))
+
+
+def node_cores():
+    """ Cores this process may run on """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def active_rasterizers():
+    """ Documents being rasterized on this node right now (one marker file each) """
+    count = 0
+    for name in os.listdir(RASTER_STATE_DIR):
+        try:
+            os.kill(int(name.split("-")[0]), 0)
+            count += 1
+        except ProcessLookupError:
+            # Left behind by a killed worker
+            try:
+                os.remove(os.path.join(RASTER_STATE_DIR, name))
+            except OSError:
+                pass
+        except (ValueError, PermissionError):
+            count += 1
+    return max(count, 1)
+
+
+def plan_lanes(first_page, last_page, cores=None, max_pages_ahead=RASTER_MAX_PREFETCH_PAGES):
+    """
+    Splits pages first_page..last_page into chunks and deals them round-robin to parallel lanes,
+    so early pages come out first. Returns a list of lanes, each a list of (first, last) chunks.
+    Every lane can hold one chunk in flight within max_pages_ahead rendered pages.
+    """
+    page_count = last_page - first_page + 1
+    cores = cores or node_cores()
+    lane_count = max(1, min(RASTER_MAX_THREADS, cores, math.ceil(page_count / RASTER_MIN_PAGES_PER_THREAD)))
+    chunk_pages = max(1, min(RASTER_CHUNK_PAGES, math.ceil(page_count / lane_count), max_pages_ahead))
+    lane_count = max(1, min(lane_count, max_pages_ahead // chunk_pages))
+
+    chunks = [(first, min(first + chunk_pages - 1, last_page)) for first in range(first_page, last_page + 1, chunk_pages)]
+    lanes = [chunks[index::lane_count] for index in range(lane_count)]
+    return [lane for lane in lanes if lane]
+
+
+def render_chunk(pdf_path, first_page, last_page, temp_dir, dpi=RASTER_DPI, jpeg_quality=RASTER_JPEG_QUALITY):
+    """ One pdftoppm pass writing pages first_page..last_page as JPEGs. Returns their paths in page order. """
+    from pdf2image import convert_from_path  # Imported on first use to keep worker startup light
+
+    paths = convert_from_path(
+        pdf_path, dpi=dpi, first_page=first_page, last_page=last_page,
+        output_folder=temp_dir, output_file=f"p{first_page:06d}_", paths_only=True,
+        fmt="jpeg", jpegopt={"quality": jpeg_quality}
+    )
+    if len(paths) != last_page - first_page + 1:
+        raise RuntimeError(f"Expected {last_page - first_page + 1} pages from {first_page}-{last_page}, got {len(paths)}")
+    return paths
+
+
+class PageBuffer:
+    """
+    Hand-off from the rasterizer lanes to the model stage. A lane reserves room for a whole chunk
+    before rendering it, so at most `limit` rendered pages wait on disk however many lanes run.
+    """
+
+    def __init__(self, limit):
+        self.limit = max(limit, 1)
+        self._free = self.limit
+        self._condition = threading.Condition()
+        self._queue = queue_module.Queue()
+
+    def make_room(self, limit):
+        """ Raises the limit, e.g. so every rasterizer lane can have a chunk in flight """
+        with self._condition:
+            if limit > self.limit:
+                self._free += limit - self.limit
+                self.limit = limit
+                self._condition.notify_all()
+
+    def reserve(self, pages, stop_event):
+        """ Blocks until `pages` slots are free. Returns False if the job stopped meanwhile. """
+        with self._condition:
+            while self._free < pages:
+                if stop_event.is_set():
+                    return False
+                self._condition.wait(timeout=1)
+            self._free -= pages
+            return True
+
+    def put(self, item):
+        self._queue.put(item)
+
+    def get(self, timeout=None):
+        """ Next (page_number, image_path, render_seconds), None at the end, or a render error """
+        item = self._queue.get(timeout=timeout)
+        if isinstance(item, tuple):
+            with self._condition:
+                self._free += 1
+                self._condition.notify_all()
+        return item
+
+
+def rasterize_pages(pdf_path, first_page, last_page, temp_dir, page_buffer, stop_event, image_settings=None):
+    """
+    Producer: renders pages in parallel lanes and hands (page_number, image_path, render_seconds)
+    to the model stage through page_buffer, then None once every page is out. A render error is
+    handed over instead. image_settings may override "dpi" and "jpeg_quality" (e.g. from a template).
+    """
+    image_settings = image_settings or {}
+    dpi = image_settings.get("dpi", RASTER_DPI)
+    jpeg_quality = image_settings.get("jpeg_quality", RASTER_JPEG_QUALITY)
+
+    os.makedirs(RASTER_STATE_DIR, exist_ok=True)
+    marker = os.path.join(RASTER_STATE_DIR, f"{os.getpid()}-{threading.get_ident()}")
+    open(marker, "w").close()
+    try:
+        cores = max(1, node_cores() // active_rasterizers())  # ✅ This document's share of the node
+        lanes = plan_lanes(first_page, last_page, cores)
+        first_chunk = lanes[0][0]
+        # ✅ Room for one chunk per lane, or the lanes would just take turns
+        page_buffer.make_room(len(lanes) * (first_chunk[1] - first_chunk[0] + 1))
+        _render_lanes(pdf_path, temp_dir, page_buffer, stop_event, lanes, dpi, jpeg_quality)
+    finally:
+        try:
+            os.remove(marker)
+        except OSError:
+            pass
+
+
+def _render_lanes(pdf_path, temp_dir, page_buffer, stop_event, lanes, dpi, jpeg_quality):
+    started = time.time()
+    rendered = []
+    errors = []
+    lane_failed = threading.Event()
+
+    def run_lane(chunks):
+        try:
+            for chunk_first, chunk_last in chunks:
+                if lane_failed.is_set() or not page_buffer.reserve(chunk_last - chunk_first + 1, stop_event):
+                    return  # ✅ Backpressure: waits until the model stage has taken earlier pages
+                chunk_start = time.time()
+                with span("rasterize", first_page=chunk_first, last_page=chunk_last):
+                    paths = render_chunk(pdf_path, chunk_first, chunk_last, temp_dir, dpi, jpeg_quality)
+                render_seconds = (time.time() - chunk_start) / len(paths)  # ✅ One pass renders the whole chunk
+
+                for page_number, image_path in zip(range(chunk_first, chunk_last + 1), paths):
+                    rendered.append(render_seconds)
+                    page_buffer.put((page_number, image_path, render_seconds))
+        except Exception as e:
+            errors.append(e)
+            lane_failed.set()
+
+    threads = [threading.Thread(target=run_lane, args=(chunks,), daemon=True, name=f"rasterize-{index}")
+               for index, chunks in enumerate(lanes)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        page_buffer.put(errors[0])
+        return
+    if rendered:
+        print(f"🔹 Rendered {len(rendered)} pages with {len(lanes)} lanes in {time.time() - started:.2f}s "
+              f"({1000 * sum(rendered) / len(rendered):.0f} ms/page)")
+    page_buffer.put(None)
@@ -0,0 +1,108 @@
+import json
+import os
+
+# ✅ Region-of-interest limits. Every tile is its own model call within one scheduler slot,
+# so the calls per page are capped as a whole, not only per region.
+MAX_REGIONS = int(os.getenv("MAX_REGIONS", 8))
+MAX_TILES_PER_REGION = int(os.getenv("MAX_TILES_PER_REGION", 4))
+MAX_REGION_CALLS_PER_PAGE = int(os.getenv("MAX_REGION_CALLS_PER_PAGE", 16))
+REGION_PADDING = float(os.getenv("REGION_PADDING", 0.01))  # Page-relative margin kept around each region
+REGION_JPEG_QUALITY = int(os.getenv("REGION_JPEG_QUALITY", 90))
+
+
+def parse_regions(raw):
+    """
+    Validates the `regions` form field and returns plain, JSON-serializable dicts:
+    [{"name", "polygon": [[x, y], ...], "prompt": str or None, "tile": [rows, cols]}]
+
+    Coordinates are page-relative (0..1, origin top-left). Raises ValueError on bad input.
+    """
+    from shapely.geometry import Polygon
+
+    try:
+        regions = json.loads(raw)
+    except ValueError:
+        raise ValueError("regions must be valid JSON")
+    if not isinstance(regions, list) or not regions:
+        raise ValueError("regions must be a non-empty list")
+    if len(regions) > MAX_REGIONS:
+        raise ValueError(f"At most {MAX_REGIONS} regions are allowed")
+
+    parsed, names = [], set()
+    for index, region in enumerate(regions):
+        if not isinstance(region, dict):
+            raise ValueError(f"Region {index} must be an object")
+        name = str(region.get("name") or f"region_{index + 1}")
+        if name in names:
+            raise ValueError(f"Duplicate region name '{name}'")
+        names.add(name)
+
+        points = region.get("polygon")
+        try:
+            points = [[float(x), float(y)] for x, y in points]
+        except (TypeError, ValueError):
+            raise ValueError(f"Region '{name}' needs a polygon of [x, y] points")
+        if len(points) < 3 or any(not (0 <= v <= 1) for point in points for v in point):
+            raise ValueError(f"Region '{name}' needs at least 3 points within 0..1")
+        polygon = Polygon(points)
+        if not polygon.is_valid or polygon.area == 0:
+            raise ValueError(f"Region '{name}' polygon is not a valid shape")
+
+        tile = region.get("tile") or [1, 1]
+        try:
+            rows, cols = int(tile[0]), int(tile[1])
+        except (TypeError, ValueError, IndexError):
+            raise ValueError(f"Region '{name}' tile must be [rows, cols]")
+        if rows < 1 or cols < 1 or rows * cols > MAX_TILES_PER_REGION:
+            raise ValueError(f"Region '{name}' may have 1 to {MAX_TILES_PER_REGION} tiles")
+
+        prompt = region.get("prompt")
+        parsed.append({"name": name, "polygon": points, "prompt": str(prompt) if prompt else None, "tile": [rows, cols]})
+
+    calls = sum(rows * cols for rows, cols in (region["tile"] for region in parsed))
+    if calls > MAX_REGION_CALLS_PER_PAGE:
+        raise ValueError(f"Regions and tiles add up to {calls} model calls per page, at most {MAX_REGION_CALLS_PER_PAGE} are allowed")
+    return parsed
+
+
+def crop_regions(image_path, regions, out_dir, page_number):
+    """
+    Cuts each region (and its tiles) out of a page image.
+    Returns [(region, tile_index, crop_path)]. Areas outside a non-rectangular polygon are blanked.
+    """
+    from PIL import Image, ImageDraw
+    from shapely.geometry import Polygon, box
+
+    crops = []
+    with Image.open(image_path) as page:
+        page = page.convert("RGB")
+        width, height = page.size
+
+        for region_index, region in enumerate(regions):
+            polygon = Polygon(region["polygon"])
+            minx, miny, maxx, maxy = polygon.buffer(REGION_PADDING, join_style=2).intersection(box(0, 0, 1, 1)).bounds
+            left, top = int(minx * width), int(miny * height)
+            right, bottom = max(int(maxx * width), left + 1), max(int(maxy * height), top + 1)
+            crop = page.crop((left, top, right, bottom))
+
+            # ✅ Non-rectangular region: blank everything outside the polygon
+            if polygon.area < polygon.envelope.area * 0.999:
+                mask = Image.new("L", crop.size, 0)
+                outline = [(x * width - left, y * height - top) for x, y in polygon.exterior.coords]
+                ImageDraw.Draw(mask).polygon(outline, fill=255)
+                blank = Image.new("RGB", crop.size, "white")
+                crop = Image.composite(crop, blank, mask)
+
+            rows, cols = region["tile"]
+            tile_width, tile_height = crop.width / cols, crop.height / rows
+            for row in range(rows):
+                for col in range(cols):
+                    tile = crop.crop((
+                        int(col * tile_width), int(row * tile_height),
+                        int((col + 1) * tile_width), int((row + 1) * tile_height)
+                    ))
+                    tile_index = row * cols + col
+                    crop_path = os.path.join(out_dir, f"page_{page_number}_r{region_index}_t{tile_index}.jpg")
+                    tile.save(crop_path, "JPEG", quality=REGION_JPEG_QUALITY)
+                    crops.append((region, tile_index, crop_path))
+    return crops
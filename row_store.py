@@ -0,0 +1,136 @@
+import csv
+import io
+import json
+import os
+import threading
+from datetime import date
+from dotenv import load_dotenv
+from initialize_database import get_db
+
+load_dotenv()
+
+# ✅ Rows buffered before one COPY round trip
+ROW_COPY_BATCH_SIZE = int(os.getenv("ROW_COPY_BATCH_SIZE", 500))
+ROW_STREAM_FETCH_SIZE = int(os.getenv("ROW_STREAM_FETCH_SIZE", 1000))
+
+COPY_COLUMNS = "(job_id, username, document_name, page_number, payload, extracted_on)"
+
+_partitions_ready = set()
+_partitions_lock = threading.Lock()
+
+
+def _month_bounds(day):
+    start = day.replace(day=1)
+    end = start.replace(year=start.year + 1, month=1) if start.month == 12 else start.replace(month=start.month + 1)
+    return start, end
+
+
+def ensure_partition(conn, day):
+    """ Creates the monthly partition for `day` once per process; rows land in the default one otherwise """
+    start, end = _month_bounds(day)
+    with _partitions_lock:
+        if start in _partitions_ready:
+            return
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(f"""
+                    CREATE TABLE IF NOT EXISTS extracted_rows_{start:%Y%m} PARTITION OF extracted_rows
+                    FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')
+                """)
+            conn.commit()
+        except Exception as e:
+            # e.g. the default partition already holds rows for this month
+            conn.rollback()
+            print(f"⚠️ Could not create partition for {start:%Y-%m}, using default: {e}")
+        _partitions_ready.add(start)
+
+
+def copy_rows(cursor, rows):
+    """
+    Bulk-loads rows with COPY in a single round trip.
+    `rows` is a list of (job_id, username, document_name, page_number, payload_dict).
+    """
+    if not rows:
+        return 0
+    today = date.today().isoformat()
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for job_id, username, document_name, page_number, payload in rows:
+        writer.writerow([job_id, username, document_name, page_number, json.dumps(payload), today])
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY extracted_rows {COPY_COLUMNS} FROM STDIN WITH (FORMAT csv)", buffer)
+    return len(rows)
+
+
+class RowWriter:
+    """ Buffers a job's rows as pages complete and flushes them with COPY in batches """
+
+    def __init__(self, job_id, username, batch_size=ROW_COPY_BATCH_SIZE):
+        self.job_id = job_id
+        self.username = username
+        self.batch_size = batch_size
+        self.pending = []
+        self.written = 0
+
+    def add(self, document_name, page_number, rows):
+        for payload in rows:
+            self.pending.append((self.job_id, self.username, document_name, page_number, payload))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """ COPYs the pending rows. A failed load is logged and retried on the next flush. """
+        if not self.pending:
+            return
+        try:
+            conn = get_db()
+            try:
+                ensure_partition(conn, date.today())
+                with conn.cursor() as cursor:
+                    self.written += copy_rows(cursor, self.pending)
+                conn.commit()
+                self.pending = []
+            finally:
+                conn.close()
+        except Exception as e:
+            # Rows are still in the Excel output, so a failed load must not fail the job
+            print(f"🚨 Error saving extracted rows for job {self.job_id}: {e}")
+
+    def close(self):
+        self.flush()
+        if self.pending:
+            print(f"🚨 {len(self.pending)} extracted rows for job {self.job_id} were not saved")
+
+
+def stream_rows(username=None, job_id=None, document_name=None):
+    """
+    Yields matching rows as dicts, read through a server-side cursor so
+    large result sets never sit in memory all at once.
+    """
+    conditions, params = [], []
+    for column, value in (("username", username), ("job_id", job_id), ("document_name", document_name)):
+        if value:
+            conditions.append(f"{column} = %s")
+            params.append(value)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    conn = get_db()
+    try:
+        with conn.cursor(name="extracted_rows_stream") as cursor:
+            cursor.itersize = ROW_STREAM_FETCH_SIZE
+            cursor.execute(f"""
+                SELECT job_id, username, document_name, page_number, payload, created_at
+                FROM extracted_rows {where}
+                ORDER BY job_id, document_name, page_number, id
+            """, params)
+            for job_id_, username_, document_name_, page_number, payload, created_at in cursor:
+                yield {
+                    "job_id": job_id_,
+                    "username": username_,
+                    "document_name": document_name_,
+                    "page_number": page_number,
+                    "payload": payload,
+                    "created_at": created_at.isoformat()
+                }
+    finally:
+        conn.close()
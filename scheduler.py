@@ -0,0 +1,335 @@
+import fcntl
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
+import queue as queue_module
+import tempfile
+import threading
+import time
+from dotenv import load_dotenv
+from hedging import HEDGE_BURST, HEDGE_DEFAULT_DELAY, HEDGE_ENABLED, HEDGE_PERCENTILE, HedgeBudget, LatencyTracker
+from initialize_database import get_db
+
+load_dotenv()
+
+# ✅ Page scheduling settings. Slots are shared by every web worker on the node (lock files in
+# SCHEDULER_STATE_DIR), so the node as a whole stays within the model quota.
+SCHEDULER_MAX_CONCURRENT_PAGES = int(os.getenv("SCHEDULER_MAX_CONCURRENT_PAGES", 8))
+SCHEDULER_RESERVED_SLOTS = int(os.getenv("SCHEDULER_RESERVED_SLOTS", 2))  # Kept free for small/interactive jobs
+SCHEDULER_STATE_DIR = os.getenv("SCHEDULER_STATE_DIR", os.path.join(tempfile.gettempdir(), "swiftextract_scheduler"))
+SCHEDULER_POLL_SECONDS = float(os.getenv("SCHEDULER_POLL_SECONDS", 0.25))  # Retry for slots freed by other workers
+SMALL_JOB_PAGES = int(os.getenv("SMALL_JOB_PAGES", 5))
+INTERACTIVE_WEIGHT = float(os.getenv("INTERACTIVE_WEIGHT", 4))
+
+PRIORITIES = ("interactive", "bulk")
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+class JobCancelled(Exception):
+    """ Raised in a document worker whose job was dropped from the schedule """
+
+
+class NodeSlots:
+    """
+    Counting semaphore shared by the web workers on this node: one lock file per slot, held with
+    flock while a page runs. The OS drops a dead worker's locks, so its slots can't leak.
+    """
+
+    def __init__(self, count, directory=SCHEDULER_STATE_DIR):
+        os.makedirs(directory, exist_ok=True)
+        self._paths = [os.path.join(directory, f"slot-{index}.lock") for index in range(count)]
+        self._held = {}  # slot index -> fd
+
+    def try_acquire(self, limit):
+        """ Takes a free slot among the first `limit` ones, or returns None """
+        for index, path in enumerate(self._paths[:limit]):
+            if index in self._held:
+                continue
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            self._held[index] = fd
+            return index
+        return None
+
+    def release(self, index):
+        fd = self._held.pop(index)
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def _merge_user_stats(users, other):
+    for username, stats in other.items():
+        merged = users.setdefault(username, {"active_documents": 0, "in_flight_pages": 0, "queued_pages": 0})
+        for key in merged:
+            merged[key] += stats.get(key, 0)
+
+
+class PageGate:
+    """
+    Handed to a document worker process. The worker asks for a slot before every
+    model call and gives it back afterwards; the scheduler decides who goes next.
+    A grant is a dict with the page's hedge delay and whether a hedge token was reserved
+    for it (see hedging.page_hedging); the page's call report goes back with release().
+    """
+
+    def __init__(self, job_key, request_queue, grant_queue):
+        self.job_key = job_key
+        self.request_queue = request_queue
+        self.grant_queue = grant_queue
+
+    def acquire(self):
+        self.request_queue.put(("acquire", self.job_key, None, None))
+        parent = multiprocessing.parent_process()
+        while True:
+            try:
+                granted = self.grant_queue.get(timeout=5)
+            except queue_module.Empty:
+                # ✅ Don't wait forever for a web worker that has gone away
+                if parent is not None and not parent.is_alive():
+                    raise RuntimeError("Scheduler process exited")
+                continue
+            if not granted:
+                self.grant_queue.put(False)  # Leave it for the document's other page threads
+                raise JobCancelled(f"Job {self.job_key} was cancelled")
+            return granted
+
+    def release(self, seconds, hedge_report=None):
+        self.request_queue.put(("release", self.job_key, seconds, hedge_report))
+
+
+class PageScheduler:
+    """
+    Weighted fair queuing of page slots across users.
+
+    Each waiting page gets a virtual finish tag: start = max(virtual time, user's last finish),
+    finish = start + 1 / weight. The smallest tag runs next, so a user with a 40-page batch
+    and a user with 2 pages alternate instead of queueing behind each other. Interactive jobs
+    get a higher weight, and the last SCHEDULER_RESERVED_SLOTS slots only go to small or
+    interactive jobs so they always have capacity.
+
+    The slots themselves are node-wide (NodeSlots): this worker's queue decides which of its pages
+    goes next, and every worker competes for the same SCHEDULER_MAX_CONCURRENT_PAGES slots. Each
+    worker also publishes its load, so admission control sees the whole node (node_snapshot).
+
+    It also keeps the model call latencies and hedge budget for every document this web worker
+    runs. Document processes are short-lived, so on their own they would rarely have enough samples
+    for a p95 or enough budget to hedge at all.
+    """
+
+    def __init__(self, capacity=SCHEDULER_MAX_CONCURRENT_PAGES, reserved=SCHEDULER_RESERVED_SLOTS):
+        self.capacity = capacity
+        self.reserved = min(reserved, max(capacity - 1, 0))
+        self.request_queue = multiprocessing.Queue()
+        self._jobs = {}
+        self._user_finish = {}
+        self._waiting = []  # heap of (finish_tag, seq, start_tag, job_key)
+        self._seq = itertools.count()
+        self._vtime = 0.0
+        self._in_flight = 0
+        self._slots = NodeSlots(capacity)
+        self._load_path = os.path.join(SCHEDULER_STATE_DIR, f"load-{os.getpid()}.json")
+        self._load_published = None
+        self._avg_page_seconds = None
+        self._latency = LatencyTracker()
+        self._hedge_budget = HedgeBudget(tokens=HEDGE_BURST)
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="page-scheduler", daemon=True)
+        self._thread.start()
+
+    def register_job(self, job_key, username, total_pages, weight=1.0, priority=None):
+        """ Adds a document to the schedule and returns the PageGate its worker should use """
+        if priority not in PRIORITIES:
+            priority = "interactive" if total_pages <= SMALL_JOB_PAGES else "bulk"
+        effective_weight = max(weight, 0.01) * (INTERACTIVE_WEIGHT if priority == "interactive" else 1)
+        grant_queue = multiprocessing.Queue()
+        with self._lock:
+            self._jobs[job_key] = {
+                "username": username,
+                "priority": priority,
+                "weight": effective_weight,
+                "small": priority == "interactive" or total_pages <= SMALL_JOB_PAGES,
+                "total_pages": total_pages,
+                "done_pages": 0,
+                "in_flight": 0,
+                "slots": [],
+                "grant_queue": grant_queue,
+            }
+        return PageGate(job_key, self.request_queue, grant_queue)
+
+    def finish_job(self, job_key):
+        """ Drops a document, reclaiming any slots its worker still held and failing its pending acquire() """
+        with self._lock:
+            job = self._jobs.pop(job_key, None)
+            if job is None:
+                return
+            job["grant_queue"].put(False)  # ✅ A worker still running (client gone) must not wait forever
+            self._in_flight -= job["in_flight"]
+            for slot in job["slots"]:
+                self._slots.release(slot)
+            self._waiting = [entry for entry in self._waiting if entry[3] != job_key]
+            heapq.heapify(self._waiting)
+            self._dispatch()
+
+    def _run(self):
+        while True:
+            try:
+                op, job_key, seconds, hedge_report = self.request_queue.get(timeout=SCHEDULER_POLL_SECONDS)
+            except queue_module.Empty:
+                with self._lock:
+                    self._dispatch()  # ✅ Another web worker may have freed a slot
+                self._publish_load()
+                continue
+            self._handle(op, job_key, seconds, hedge_report)
+            self._publish_load()
+
+    def _handle(self, op, job_key, seconds, hedge_report):
+        if hedge_report:
+            self._record_calls(hedge_report)
+        with self._lock:
+            job = self._jobs.get(job_key)
+            if job is None:
+                return
+            if op == "acquire":
+                start = max(self._vtime, self._user_finish.get(job["username"], 0.0))
+                finish = start + 1.0 / job["weight"]
+                self._user_finish[job["username"]] = finish
+                heapq.heappush(self._waiting, (finish, next(self._seq), start, job_key))
+            elif op == "release":
+                job["in_flight"] -= 1
+                job["done_pages"] += 1
+                self._in_flight -= 1
+                self._slots.release(job["slots"].pop())
+                if seconds is not None:
+                    # ✅ Smoothed page latency, used for queue wait estimates
+                    if self._avg_page_seconds is None:
+                        self._avg_page_seconds = seconds
+                    else:
+                        self._avg_page_seconds = 0.8 * self._avg_page_seconds + 0.2 * seconds
+            self._dispatch()
+
+    def _record_calls(self, report):
+        for call_seconds in report["latencies"]:
+            self._latency.record(call_seconds)
+        self._hedge_budget.earn(report["calls"])
+        if report["hedge_reserved"] and not report["hedged"]:
+            self._hedge_budget.refund()
+
+    def _grant(self):
+        """ A slot, with a hedge token reserved for it when the budget has one """
+        return {
+            "hedge_delay": self._latency.percentile(HEDGE_PERCENTILE) or HEDGE_DEFAULT_DELAY,
+            "hedge_reserved": HEDGE_ENABLED and self._hedge_budget.try_spend(),
+        }
+
+    def _dispatch(self):
+        while self._waiting:
+            entry = self._waiting[0]
+            small = self._jobs[entry[3]]["small"]
+            slot = self._slots.try_acquire(self.capacity if small else self.capacity - self.reserved)
+            if slot is None:
+                # Shared slots full: only small/interactive pages may take a reserved slot
+                eligible = [entry for entry in self._waiting if self._jobs[entry[3]]["small"]]
+                if small or not eligible:
+                    return
+                slot = self._slots.try_acquire(self.capacity)
+                if slot is None:
+                    return
+                entry = min(eligible)
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+            else:
+                heapq.heappop(self._waiting)
+
+            _, _, start, job_key = entry
+            job = self._jobs[job_key]
+            self._vtime = max(self._vtime, start)
+            job["in_flight"] += 1
+            job["slots"].append(slot)
+            self._in_flight += 1
+            job["grant_queue"].put(self._grant())
+
+    def _publish_load(self):
+        """ Writes this worker's per-user load for the other workers' node_snapshot(), when it changed """
+        users = self.snapshot()["users"]
+        if users == self._load_published:
+            return
+        try:
+            tmp_path = f"{self._load_path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(users, f)
+            os.replace(tmp_path, self._load_path)
+            self._load_published = users
+        except OSError as e:
+            print(f"⚠️ Could not publish scheduler load: {e}")
+
+    def node_snapshot(self):
+        """ snapshot() with the queued and in-flight pages of every web worker on this node """
+        stats = self.snapshot()
+        own = os.path.basename(self._load_path)
+        for name in os.listdir(SCHEDULER_STATE_DIR):
+            if not name.startswith("load-") or not name.endswith(".json") or name == own:
+                continue
+            path = os.path.join(SCHEDULER_STATE_DIR, name)
+            try:
+                os.kill(int(name[len("load-"):-len(".json")]), 0)
+                with open(path) as f:
+                    other = json.load(f)
+            except ProcessLookupError:
+                try:
+                    os.remove(path)  # Left behind by a web worker that died
+                except OSError:
+                    pass
+                continue
+            except (OSError, ValueError):
+                continue
+            _merge_user_stats(stats["users"], other)
+        stats["in_flight_pages"] = sum(user["in_flight_pages"] for user in stats["users"].values())
+        stats["queued_pages"] = sum(user["queued_pages"] for user in stats["users"].values())
+        return stats
+
+    def snapshot(self):
+        """ Per-user in-flight and queued page counts in this web worker """
+        with self._lock:
+            users = {}
+            for job in self._jobs.values():
+                stats = users.setdefault(job["username"], {"active_documents": 0, "in_flight_pages": 0, "queued_pages": 0})
+                stats["active_documents"] += 1
+                stats["in_flight_pages"] += job["in_flight"]
+                stats["queued_pages"] += max(job["total_pages"] - job["done_pages"] - job["in_flight"], 0)
+            return {
+                "capacity": self.capacity,
+                "reserved_slots": self.reserved,
+                "in_flight_pages": self._in_flight,
+                "queued_pages": sum(stats["queued_pages"] for stats in users.values()),
+                "avg_page_seconds": round(self._avg_page_seconds, 2) if self._avg_page_seconds else None,
+                "users": users,
+            }
+
+
+def get_scheduler():
+    """ Returns this process's scheduler, starting it on first use """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = PageScheduler()
+        return _scheduler
+
+
+def get_user_share_weight(username):
+    """ Reads the user's fair-share weight (users.share_weight, default 1) """
+    conn = get_db()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT share_weight FROM users WHERE username = %s", (username,))
+            row = cursor.fetchone()
+        return float(row[0]) if row and row[0] is not None else 1.0
+    finally:
+        conn.close()
@@ -0,0 +1,231 @@
+import os
+import re
+import secrets
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
+from werkzeug.datastructures import CallbackDict
+from dotenv import load_dotenv
+from initialize_database import get_db
+
+load_dotenv()
+
+# ✅ Session backend: "postgres" (shared by every node), "memory" (per process) or "filesystem" (legacy)
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "postgres")
+SESSION_MEMORY_MAX_ENTRIES = int(os.getenv("SESSION_MEMORY_MAX_ENTRIES", 10000))
+SESSION_CLEANUP_INTERVAL = int(os.getenv("SESSION_CLEANUP_INTERVAL", 600))
+
+SID_RE = re.compile(r"^[A-Za-z0-9_-]{43}$")
+
+_cleanup_thread = None
+_cleanup_lock = threading.Lock()
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """ Session dict that only carries an opaque id in the cookie """
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(session):
+            session.modified = True
+
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+
+class ServerSideSessionInterface(SessionInterface, ABC):
+    """
+    Shared cookie handling; subclasses implement load/store/delete.
+    Session data goes through Flask's tagged serializer, so tuples, bytes, datetimes and Markup
+    come back as they went in, just like with the default cookie sessions.
+    """
+
+    serializer = session_json_serializer
+
+    @abstractmethod
+    def load(self, sid):
+        """ The session dict, or None if it doesn't exist or has expired """
+
+    @abstractmethod
+    def store(self, sid, data, ttl_seconds):
+        """ Saves the session dict for ttl_seconds """
+
+    @abstractmethod
+    def delete(self, sid):
+        """ Removes the session, if it exists """
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid and SID_RE.match(sid):
+            data = self.load(sid)
+            if data is not None:
+                return ServerSideSession(data, sid=sid)
+        return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.modified:
+                self.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        # ✅ Read-only requests do no session I/O at all
+        if not self.should_set_cookie(app, session):
+            return
+
+        ttl_seconds = int(app.permanent_session_lifetime.total_seconds())
+        self.store(session.sid, dict(session), ttl_seconds)
+        response.set_cookie(
+            name,
+            session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+
+class PostgresSessionInterface(ServerSideSessionInterface):
+    """ Sessions in the `sessions` table, so any worker on any node can serve any request """
+
+    def load(self, sid):
+        conn = get_db()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT data::text FROM sessions WHERE sid = %s AND expires_at > CURRENT_TIMESTAMP", (sid,))
+                row = cursor.fetchone()
+            return self.serializer.loads(row[0]) if row else None
+        finally:
+            conn.close()
+
+    def store(self, sid, data, ttl_seconds):
+        conn = get_db()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    INSERT INTO sessions (sid, data, expires_at)
+                    VALUES (%s, %s, CURRENT_TIMESTAMP + make_interval(secs => %s))
+                    ON CONFLICT (sid) DO UPDATE SET data = EXCLUDED.data, expires_at = EXCLUDED.expires_at
+                """, (sid, self.serializer.dumps(data), ttl_seconds))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def delete(self, sid):
+        conn = get_db()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("DELETE FROM sessions WHERE sid = %s", (sid,))
+            conn.commit()
+        finally:
+            conn.close()
+
+
+class MemorySessionInterface(ServerSideSessionInterface):
+    """
+    In-process LRU with expiry. Fast, but sessions stay on the worker that created them.
+    Entries are kept serialized, so later changes to a request's session objects don't leak into the store.
+    """
+
+    def __init__(self, max_entries=SESSION_MEMORY_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # sid -> (expires_at, data)
+        self._lock = threading.Lock()
+
+    def load(self, sid):
+        with self._lock:
+            entry = self._entries.get(sid)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._entries[sid]
+                return None
+            self._entries.move_to_end(sid)
+            data = entry[1]
+        return self.serializer.loads(data)
+
+    def store(self, sid, data, ttl_seconds):
+        data = self.serializer.dumps(data)
+        with self._lock:
+            self._entries[sid] = (time.time() + ttl_seconds, data)
+            self._entries.move_to_end(sid)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, sid):
+        with self._lock:
+            self._entries.pop(sid, None)
+
+    def cleanup_expired(self):
+        now = time.time()
+        with self._lock:
+            expired = [sid for sid, (expires_at, _) in self._entries.items() if expires_at <= now]
+            for sid in expired:
+                del self._entries[sid]
+        return len(expired)
+
+
+def cleanup_expired_sessions():
+    """ Deletes expired rows from the `sessions` table """
+    conn = get_db()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("DELETE FROM sessions WHERE expires_at <= CURRENT_TIMESTAMP")
+            removed = cursor.rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    if removed:
+        print(f"🧹 Removed {removed} expired session(s)")
+    return removed
+
+
+def _cleanup_forever(interface):
+    while True:
+        time.sleep(SESSION_CLEANUP_INTERVAL)
+        try:
+            if isinstance(interface, MemorySessionInterface):
+                interface.cleanup_expired()
+            else:
+                cleanup_expired_sessions()
+        except Exception as e:
+            print(f"🚨 Session cleanup error: {e}")
+
+
+def init_app(app):
+    """ Installs the configured session backend on the app """
+    if SESSION_BACKEND == "filesystem":
+        from flask_session import Session
+        app.config["SESSION_TYPE"] = "filesystem"  # Pins sessions to this node's disk
+        Session(app)
+        return
+
+    if SESSION_BACKEND == "memory":
+        interface = MemorySessionInterface()
+    elif SESSION_BACKEND == "postgres":
+        interface = PostgresSessionInterface()
+    else:
+        raise ValueError(f"🚨 Unknown SESSION_BACKEND '{SESSION_BACKEND}'")
+
+    app.session_interface = interface
+
+
+def start_cleanup(app):
+    """ Starts the expired-session cleanup thread once per process (the legacy filesystem backend needs none) """
+    global _cleanup_thread
+    interface = app.session_interface
+    if not isinstance(interface, ServerSideSessionInterface):
+        return
+    with _cleanup_lock:
+        if _cleanup_thread is None or not _cleanup_thread.is_alive():
+            _cleanup_thread = threading.Thread(target=_cleanup_forever, args=(interface,), name="session-cleanup", daemon=True)
+            _cleanup_thread.start()
@@ -0,0 +1,144 @@
+import json
+import os
+import re
+import threading
+import time
+from dotenv import load_dotenv
+from initialize_database import get_db
+
+load_dotenv()
+
+# ✅ Templates are read on every job, so each process keeps them for TEMPLATE_CACHE_TTL seconds.
+# Edits show up on other workers within that window.
+TEMPLATE_CACHE_TTL = int(os.getenv("TEMPLATE_CACHE_TTL", 60))
+TEMPLATE_MODELS = [m.strip() for m in os.getenv("TEMPLATE_MODELS", "gemini-1.5-flash-002,gemini-1.5-pro-002").split(",") if m.strip()]
+TEMPLATE_ID_RE = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+IMAGE_SETTING_LIMITS = {"dpi": (72, 600), "jpeg_quality": (30, 100)}
+
+TEMPLATE_COLUMNS = ("template_id", "prompt", "output_schema", "model", "image_settings", "regions", "version")
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def validate_template(data):
+    """ Checks an admin's template payload and returns the fields to store. Raises ValueError. """
+    template_id = str(data.get("template_id") or "")
+    if not TEMPLATE_ID_RE.match(template_id):
+        raise ValueError("template_id must be 1-64 letters, digits, '.', '_' or '-'")
+    prompt = data.get("prompt")
+    if not isinstance(prompt, str) or not prompt.strip():
+        raise ValueError("prompt is required")
+
+    output_schema = data.get("output_schema")
+    if output_schema is not None and not isinstance(output_schema, dict):
+        raise ValueError("output_schema must be a JSON schema object")
+
+    model = data.get("model") or TEMPLATE_MODELS[0]
+    if model not in TEMPLATE_MODELS:
+        raise ValueError(f"model must be one of {', '.join(TEMPLATE_MODELS)}")
+
+    image_settings = data.get("image_settings") or {}
+    if not isinstance(image_settings, dict):
+        raise ValueError("image_settings must be an object")
+    for key, value in image_settings.items():
+        if key not in IMAGE_SETTING_LIMITS:
+            raise ValueError(f"Unknown image setting '{key}'")
+        low, high = IMAGE_SETTING_LIMITS[key]
+        if not isinstance(value, int) or not low <= value <= high:
+            raise ValueError(f"{key} must be a whole number from {low} to {high}")
+
+    regions = data.get("regions")
+    if regions:
+        from regions import parse_regions
+        regions = parse_regions(json.dumps(regions))
+
+    return {
+        "template_id": template_id,
+        "prompt": prompt,
+        "output_schema": output_schema,
+        "model": model,
+        "image_settings": image_settings,
+        "regions": regions or None
+    }
+
+
+def get_template(template_id):
+    """ The template as a dict, or None if there is no such template """
+    now = time.time()
+    with _cache_lock:
+        cached = _cache.get(template_id)
+        if cached and cached[0] > now:
+            return cached[1]
+
+    conn = get_db()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"SELECT {', '.join(TEMPLATE_COLUMNS)} FROM templates WHERE template_id = %s", (template_id,))
+            row = cursor.fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+
+    template = dict(zip(TEMPLATE_COLUMNS, row))
+    with _cache_lock:
+        _cache[template_id] = (now + TEMPLATE_CACHE_TTL, template)
+    return template
+
+
+def list_templates():
+    conn = get_db()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"SELECT {', '.join(TEMPLATE_COLUMNS)}, updated_by, updated_at FROM templates ORDER BY template_id")
+            rows = cursor.fetchall()
+    finally:
+        conn.close()
+    templates = []
+    for row in rows:
+        template = dict(zip(TEMPLATE_COLUMNS + ("updated_by", "updated_at"), row))
+        template["updated_at"] = template["updated_at"].isoformat() if template["updated_at"] else None
+        templates.append(template)
+    return templates
+
+
+def save_template(template, username):
+    """ Creates or replaces a template; every replacement bumps its version. Returns the new version. """
+    conn = get_db()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO templates (template_id, prompt, output_schema, model, image_settings, regions, updated_by)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (template_id) DO UPDATE
+                SET prompt = EXCLUDED.prompt, output_schema = EXCLUDED.output_schema, model = EXCLUDED.model,
+                    image_settings = EXCLUDED.image_settings, regions = EXCLUDED.regions,
+                    updated_by = EXCLUDED.updated_by, version = templates.version + 1, updated_at = CURRENT_TIMESTAMP
+                RETURNING version
+            """, (template["template_id"], template["prompt"],
+                  json.dumps(template["output_schema"]) if template["output_schema"] is not None else None,
+                  template["model"], json.dumps(template["image_settings"]),
+                  json.dumps(template["regions"]) if template["regions"] else None, username))
+            version = cursor.fetchone()[0]
+        conn.commit()
+    finally:
+        conn.close()
+    with _cache_lock:
+        _cache.pop(template["template_id"], None)
+    return version
+
+
+def delete_template(template_id):
+    """ Returns True if the template existed """
+    conn = get_db()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("DELETE FROM templates WHERE template_id = %s", (template_id,))
+            deleted = cursor.rowcount == 1
+        conn.commit()
+    finally:
+        conn.close()
+    with _cache_lock:
+        _cache.pop(template_id, None)
+    return deleted
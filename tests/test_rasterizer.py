@@ -0,0 +1,71 @@
+import threading
+import unittest
+
+from rasterizer import RASTER_CHUNK_PAGES, RASTER_MAX_THREADS, PageBuffer, plan_lanes
+
+
+def pages_of(lanes):
+    return sorted(page for lane in lanes for first, last in lane for page in range(first, last + 1))
+
+
+class PlanLanesTest(unittest.TestCase):
+
+    def test_large_document_uses_every_lane(self):
+        lanes = plan_lanes(1, 300, cores=16)
+        self.assertEqual(len(lanes), RASTER_MAX_THREADS)
+        self.assertEqual(lanes[0][0], (1, RASTER_CHUNK_PAGES))
+        self.assertEqual(pages_of(lanes), list(range(1, 301)))
+
+    def test_lanes_follow_cores(self):
+        self.assertEqual(len(plan_lanes(1, 300, cores=3)), 3)
+        self.assertEqual(len(plan_lanes(1, 300, cores=1)), 1)
+
+    def test_small_document_stays_in_one_pass(self):
+        self.assertEqual(plan_lanes(1, 3, cores=16), [[(1, 3)]])
+
+    def test_early_pages_come_first(self):
+        lanes = plan_lanes(1, 40, cores=4)
+        self.assertEqual([lane[0][0] for lane in lanes], [1, 5, 9, 13])
+
+    def test_lanes_fit_the_prefetch_bound(self):
+        lanes = plan_lanes(1, 300, cores=16, max_pages_ahead=10)
+        chunk_pages = lanes[0][0][1] - lanes[0][0][0] + 1
+        self.assertLessEqual(len(lanes) * chunk_pages, 10)
+        self.assertEqual(pages_of(lanes), list(range(1, 301)))
+
+    def test_page_range_offset(self):
+        lanes = plan_lanes(101, 120, cores=2)
+        self.assertEqual(pages_of(lanes), list(range(101, 121)))
+
+
+class PageBufferTest(unittest.TestCase):
+
+    def test_reserve_waits_for_pages_to_be_taken(self):
+        buffer = PageBuffer(2)
+        stop_event = threading.Event()
+        self.assertTrue(buffer.reserve(2, stop_event))
+        buffer.put((1, "p1.jpg", 0.1))
+
+        reserved = threading.Event()
+        thread = threading.Thread(target=lambda: buffer.reserve(1, stop_event) and reserved.set())
+        thread.start()
+        self.assertFalse(reserved.wait(0.2))
+        self.assertEqual(buffer.get(timeout=1)[0], 1)
+        self.assertTrue(reserved.wait(2))
+        thread.join()
+
+    def test_make_room_frees_waiting_lanes(self):
+        buffer = PageBuffer(1)
+        stop_event = threading.Event()
+        buffer.make_room(4)
+        self.assertTrue(buffer.reserve(4, stop_event))
+
+    def test_reserve_gives_up_when_stopped(self):
+        buffer = PageBuffer(1)
+        stop_event = threading.Event()
+        stop_event.set()
+        self.assertFalse(buffer.reserve(2, stop_event))
+
+
+if __name__ == "__main__":
+    unittest.main()
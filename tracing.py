@@ -0,0 +1,180 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# ✅ Per-job tracing. Each worker process appends Chrome trace events to its own trace-<pid>.jsonl
+# in the job's trace folder; the web worker merges them into one trace.json when the job ends.
+TRACE_SAMPLE_INTERVAL_MS = float(os.getenv("TRACE_SAMPLE_INTERVAL_MS", 10))
+TRACE_PROFILE_TOP_STACKS = int(os.getenv("TRACE_PROFILE_TOP_STACKS", 200))
+TRACE_MODES = ("trace", "profile")
+
+_trace_file = None
+_sampler = None
+_lock = threading.Lock()
+_named_threads = set()
+
+
+def parse_trace_mode(value):
+    """ Maps the `trace` form field to None, "trace" or "profile" (trace + stack sampling). Raises ValueError. """
+    value = (value or "").strip().lower()
+    if value in ("", "0", "false"):
+        return None
+    if value in ("1", "true"):
+        return "trace"
+    if value not in TRACE_MODES:
+        raise ValueError("trace must be one of 0, 1, trace or profile")
+    return value
+
+
+class StackSampler(threading.Thread):
+    """
+    Samples every thread's Python stack at a fixed interval and counts the collapsed stacks.
+    Unlike cProfile, this sees the rasterizer, page and model-call threads, not only the caller's.
+    """
+
+    def __init__(self, interval):
+        super().__init__(daemon=True, name="stack-sampler")
+        self.interval = interval
+        self.counts = Counter()
+        self._stopping = threading.Event()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self._stopping.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                self.counts[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopping.set()
+        self.join()
+        return dict(self.counts.most_common(TRACE_PROFILE_TOP_STACKS))
+
+
+def _write(event):
+    with _lock:
+        if _trace_file is None:
+            return
+        tid = threading.get_native_id()
+        if tid not in _named_threads:
+            _named_threads.add(tid)
+            _trace_file.write(json.dumps({"ph": "M", "name": "thread_name", "pid": os.getpid(), "tid": tid,
+                                          "args": {"name": threading.current_thread().name}}) + "\n")
+        event.update(pid=os.getpid(), tid=tid)
+        _trace_file.write(json.dumps(event, default=str) + "\n")
+
+
+def record(name, start, end, **args):
+    """ Records a finished span from epoch-second timestamps """
+    if _trace_file is not None:
+        _write({"ph": "X", "name": name, "ts": int(start * 1e6), "dur": int((end - start) * 1e6), "args": args})
+
+
+def instant(name, **args):
+    if _trace_file is not None:
+        _write({"ph": "i", "s": "t", "name": name, "ts": int(time.time() * 1e6), "args": args})
+
+
+@contextmanager
+def span(name, **args):
+    """ Times the enclosed block. Yields the span's args, so results (e.g. hedged) can be added to it. """
+    if _trace_file is None:
+        yield args
+        return
+    start = time.time()
+    try:
+        yield args
+    finally:
+        record(name, start, time.time(), **args)
+
+
+def start_trace(trace_dir, profile=False, label=None):
+    """ Starts recording this process's spans into trace_dir, optionally with stack sampling """
+    global _trace_file, _sampler
+    os.makedirs(trace_dir, exist_ok=True)
+    _named_threads.clear()
+    _trace_file = open(os.path.join(trace_dir, f"trace-{os.getpid()}.jsonl"), "a", buffering=1)
+    _write({"ph": "M", "name": "process_name", "args": {"name": label or f"worker {os.getpid()}"}})
+    if profile:
+        _sampler = StackSampler(TRACE_SAMPLE_INTERVAL_MS / 1000)
+        _sampler.start()
+
+
+def stop_trace():
+    """ Stops recording and writes the stack samples (if any) next to the trace file """
+    global _trace_file, _sampler
+    if _trace_file is None:
+        return
+    trace_dir = os.path.dirname(_trace_file.name)
+    if _sampler is not None:
+        with open(os.path.join(trace_dir, f"samples-{os.getpid()}.json"), "w") as f:
+            json.dump(_sampler.stop(), f)
+        _sampler = None
+    with _lock:
+        _trace_file.close()
+        _trace_file = None
+
+
+@contextmanager
+def captured(mode, label=None):
+    """ Traces the enclosed work into a temporary folder. Yields a dict that holds the trace on exit. """
+    trace = {}
+    if not mode:
+        yield trace
+        return
+    trace_dir = tempfile.mkdtemp(prefix="trace-")
+    start_trace(trace_dir, profile=mode == "profile", label=label)
+    try:
+        yield trace
+    finally:
+        stop_trace()
+        trace.update(read_trace(trace_dir))
+        shutil.rmtree(trace_dir, ignore_errors=True)
+
+
+def read_trace(trace_dir):
+    """ Collects every process's events and stack samples from a trace folder """
+    events, samples = [], {}
+    if os.path.isdir(trace_dir):
+        for name in sorted(os.listdir(trace_dir)):
+            path = os.path.join(trace_dir, name)
+            if name.startswith("trace-") and name.endswith(".jsonl"):
+                with open(path) as f:
+                    for line in f:
+                        try:
+                            events.append(json.loads(line))
+                        except ValueError:
+                            pass  # Last line of a process that was killed mid-write
+            elif name.startswith("samples-") and name.endswith(".json"):
+                with open(path) as f:
+                    samples[name[len("samples-"):-len(".json")]] = json.load(f)
+    return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"stack_samples": samples}}
+
+
+def merge_traces(traces):
+    """ Combines traces from several folders or hosts into one Chrome trace """
+    merged = {"traceEvents": [], "displayTimeUnit": "ms", "otherData": {"stack_samples": {}}}
+    for trace in traces:
+        merged["traceEvents"].extend(trace.get("traceEvents", []))
+        merged["otherData"]["stack_samples"].update(trace.get("otherData", {}).get("stack_samples", {}))
+    return merged
+
+
+def write_trace(trace, path):
+    with open(path, "w") as f:
+        json.dump(trace, f)
+    return path
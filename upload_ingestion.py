@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import secrets
+from flask import Request, request
+from werkzeug.exceptions import RequestEntityTooLarge
+from artifact_store import create_job_dir, remove_job_dir
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# ✅ Upload limits, enforced while the body is still streaming in
+MAX_UPLOAD_FILE_BYTES = int(os.getenv("MAX_UPLOAD_FILE_BYTES", 50 * 1024 * 1024))
+MAX_UPLOAD_REQUEST_BYTES = int(os.getenv("MAX_UPLOAD_REQUEST_BYTES", 500 * 1024 * 1024))
+MAX_PAGES_PER_FILE = int(os.getenv("MAX_PAGES_PER_FILE", 500))
+MAX_PAGES_PER_REQUEST = int(os.getenv("MAX_PAGES_PER_REQUEST", 2000))
+
+
+class UploadRejected(Exception):
+    """ Raised when an uploaded file breaks one of the upload limits """
+
+
+class HashingFileWriter:
+    """
+    File-like sink handed to Werkzeug's multipart parser.
+    Chunks go straight to the job directory while a SHA-256 is computed on the fly.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._file = open(path, "w+b")
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise RequestEntityTooLarge(f"Each PDF must be at most {self.max_bytes} bytes")
+        self._hash.update(chunk)
+        return self._file.write(chunk)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class StreamingUploadRequest(Request):
+    """ Request class that streams file parts into the artifact store instead of spooling them """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if content_length is not None and content_length > MAX_UPLOAD_FILE_BYTES:
+            raise RequestEntityTooLarge(f"Each PDF must be at most {MAX_UPLOAD_FILE_BYTES} bytes")
+        _, job_dir = get_upload_job()
+        part_path = os.path.join(job_dir, f"upload_{secrets.token_hex(8)}.part")
+        return HashingFileWriter(part_path, MAX_UPLOAD_FILE_BYTES)
+
+
+def get_upload_job():
+    """ Returns (job_id, job_dir) for the current request, creating it on first use """
+    if getattr(request, "upload_job", None) is None:
+        request.upload_job = create_job_dir()
+    return request.upload_job
+
+
+def _discard_upload_job(exc=None):
+    upload_job = getattr(request, "upload_job", None)
+    if upload_job is not None:
+        remove_job_dir(upload_job[0])
+
+
+def init_app(app):
+    app.request_class = StreamingUploadRequest
+    app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_REQUEST_BYTES
+    # ✅ Runs when the request (or its streamed response) is finished, on every exit path
+    app.teardown_request(_discard_upload_job)
+
+
+def ingest_upload(pdf_file):
+    """
+    Finalizes one streamed upload: names it, checks its page count and returns
+    {"path", "document_name", "sha256", "size", "pages"}.
+    """
+    writer = pdf_file.stream
+    if not isinstance(writer, HashingFileWriter):
+        raise UploadRejected("Upload was not streamed to disk")
+    writer.close()
+
+    original_filename = pdf_file.filename or "document.pdf"
+    safe_filename = "".join(c for c in original_filename if c.isalnum() or c in (" ", ".", "_")).strip() or "document.pdf"
+    pdf_path = os.path.join(os.path.dirname(writer.path), safe_filename)
+    if os.path.exists(pdf_path):
+        pdf_path = os.path.join(os.path.dirname(writer.path), f"{writer.hexdigest()[:8]}_{safe_filename}")
+    os.replace(writer.path, pdf_path)
+
+    # ✅ pdfinfo reads the page tree only, no rasterizing needed to count pages
+    from pdf2image import pdfinfo_from_path
+    try:
+        pages = int(pdfinfo_from_path(pdf_path)["Pages"])
+    except Exception as e:
+        raise UploadRejected(f"'{original_filename}' is not a readable PDF: {e}")
+
+    if pages > MAX_PAGES_PER_FILE:
+        raise UploadRejected(f"'{original_filename}' has {pages} pages, the limit is {MAX_PAGES_PER_FILE}")
+
+    return {
+        "path": pdf_path,
+        "document_name": os.path.basename(pdf_path),
+        "sha256": writer.hexdigest(),
+        "size": writer.size,
+        "pages": pages,
+    }
+
+
+def result_cache_key(file_sha256, prompt, regions=None, template=None):
+    """ Identical PDF bytes + identical prompt (regions, template settings) -> identical extraction result """
+    key = f"{file_sha256}\0{prompt}"
+    if regions:
+        key += "\0" + json.dumps(regions, sort_keys=True)
+    if template:
+        settings = {name: template.get(name) for name in ("model", "output_schema", "image_settings")}
+        key += "\0" + json.dumps(settings, sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
@@ -0,0 +1,502 @@
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+from datetime import date
+from dotenv import load_dotenv
+from initialize_database import get_db
+from row_store import copy_rows, ensure_partition
+from tracing import captured
+from template_registry import get_template
+
+load_dotenv()
+
+# ✅ Distributed execution settings
+EXECUTION_MODE = os.getenv("EXECUTION_MODE", "local")  # "local" (forked processes) or "distributed"
+TASK_PAGES = int(os.getenv("TASK_PAGES", 10))  # Pages per claimable task
+LEASE_SECONDS = int(os.getenv("LEASE_SECONDS", 120))
+HEARTBEAT_SECONDS = int(os.getenv("HEARTBEAT_SECONDS", 20))
+TASK_MAX_ATTEMPTS = int(os.getenv("TASK_MAX_ATTEMPTS", 3))
+WORKER_POLL_INTERVAL = float(os.getenv("WORKER_POLL_INTERVAL", 1))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 1))
+WORK_QUEUE_RETENTION_HOURS = int(os.getenv("WORK_QUEUE_RETENTION_HOURS", 24))
+WORKER_CACHE_DIR = os.getenv("WORKER_CACHE_DIR", os.path.join(tempfile.gettempdir(), "swiftextract_worker"))
+
+
+class LeaseLost(Exception):
+    """ Raised in a worker when another worker has taken over its task """
+
+
+def enqueue_document(job_id, username, document_name, pdf_path, sha256, total_pages, prompt, deadline=None,
+                     regions=None, trace_mode=None, template_id=None, context_cache=None):
+    """ Stores the PDF once (by hash) and splits it into page-range tasks any worker can claim """
+    conn = get_db()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM job_documents WHERE sha256 = %s", (sha256,))
+            if cursor.fetchone() is None:
+                with open(pdf_path, "rb") as f:
+                    content = f.read()
+                cursor.execute("""
+                    INSERT INTO job_documents (sha256, content) VALUES (%s, %s)
+                    ON CONFLICT (sha256) DO NOTHING
+                """, (sha256, content))
+
+            regions_json = json.dumps(regions) if regions else None
+            ranges = [(first, min(first + TASK_PAGES - 1, total_pages)) for first in range(1, total_pages + 1, TASK_PAGES)]
+            cursor.executemany("""
+                INSERT INTO page_tasks (job_id, username, document_name, document_sha256, prompt, first_page, last_page,
+                                        total_pages, deadline_at, regions, trace_mode, template_id, context_cache)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, to_timestamp(%s), %s, %s, %s, %s)
+            """, [(job_id, username, document_name, sha256, prompt, first, last, total_pages, deadline, regions_json,
+                   trace_mode, template_id, context_cache) for first, last in ranges])
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def cancel_job(job_id):
+    """ Stops unclaimed tasks of a job whose requester went away """
+    conn = get_db()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                UPDATE page_tasks SET status = 'cancelled', updated_at = CURRENT_TIMESTAMP
+                WHERE job_id = %s AND status = 'queued'
+            """, (job_id,))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+# ---------------------------------------------------------------------------
+# Originating request side
+# ---------------------------------------------------------------------------
+
+def expire_job_tasks(job_id, include_running=False):
+    """ Marks a job's unclaimed (and optionally running) tasks past their deadline as expired """
+    statuses = ("queued", "running") if include_running else ("queued",)
+    conn = get_db()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                UPDATE page_tasks SET status = 'expired', lease_owner = NULL, lease_expires_at = NULL,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE job_id = %s AND status IN %s AND deadline_at < CURRENT_TIMESTAMP
+            """, (job_id, statuses))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def poll_job(job_id, total_pages_global, on_document_done=None, deadline=None):
+    """
+    Yields progress messages for a distributed job, in the same shape process_pdf
+    puts on its queue, until every document's tasks have finished or the deadline passed.
+    """
+    pages_seen = {}
+    finished_documents = set()
+
+    while True:
+        if deadline is not None and time.time() > deadline:
+            # ✅ Queued tasks won't start; running ones get a grace period to report their partial pages
+            expire_job_tasks(job_id, include_running=time.time() > deadline + HEARTBEAT_SECONDS)
+
+        conn = get_db()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT document_name, MAX(total_pages), SUM(pages_done),
+                           COUNT(*) FILTER (WHERE status NOT IN ('done', 'failed', 'cancelled', 'expired')),
+                           COUNT(*) FILTER (WHERE status = 'failed')
+                    FROM page_tasks WHERE job_id = %s
+                    GROUP BY document_name
+                """, (job_id,))
+                documents = cursor.fetchall()
+        finally:
+            conn.close()
+
+        for document_name, total_pages, pages_done, unfinished, failed in documents:
+            pages_done = int(pages_done or 0)
+            for page_index in range(pages_seen.get(document_name, 0) + 1, pages_done + 1):
+                yield {
+                    "document_name": document_name,
+                    "page_number": page_index,
+                    "total_pages": total_pages,
+                    "progress": round((page_index / total_pages) * 100, 2),
+                    "total_pages_global": total_pages_global,
+                    "current_page_processed": 1
+                }
+            pages_seen[document_name] = max(pages_seen.get(document_name, 0), pages_done)
+
+            if unfinished == 0 and document_name not in finished_documents:
+                finished_documents.add(document_name)
+                result = collect_document(job_id, document_name)
+                if on_document_done is not None:
+                    on_document_done(result)
+                yield result
+
+        if documents and len(finished_documents) == len(documents):
+            return
+        time.sleep(JOB_POLL_INTERVAL)
+
+
+def collect_document(job_id, document_name):
+    """ Merges a document's finished tasks into one completion message """
+    conn = get_db()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT first_page, last_page, total_pages, status, extracted_data, skipped_pages, total_time, error, unprocessed_pages,
+                       stopped_for_deadline
+                FROM page_tasks WHERE job_id = %s AND document_name = %s
+                ORDER BY first_page
+            """, (job_id, document_name))
+            tasks = cursor.fetchall()
+    finally:
+        conn.close()
+
+    all_data, skipped_pages, unprocessed_pages, errors = [], [], [], []
+    total_time = 0
+    total_pages = tasks[0][2] if tasks else 0
+    stopped_for_deadline = False
+    for first_page, last_page, _, status, extracted_data, task_skipped, task_time, error, task_unprocessed, task_deadline_stop in tasks:
+        if status == "done":
+            all_data.extend(extracted_data or [])
+            skipped_pages.extend(task_skipped or [])
+            unprocessed_pages.extend(task_unprocessed or [])
+            total_time += task_time or 0
+            stopped_for_deadline = stopped_for_deadline or bool(task_deadline_stop)
+        elif status in ("expired", "cancelled"):
+            unprocessed_pages.extend(range(first_page, last_page + 1))
+            stopped_for_deadline = stopped_for_deadline or status == "expired"  # Only deadlines expire tasks
+        else:
+            skipped_pages.extend(range(first_page, last_page + 1))
+            if error:
+                errors.append(error)
+
+    total_time = round(total_time, 2)
+    message = {
+        "completed": True,
+        "document_name": document_name,
+        "total_pages": total_pages,
+        "total_time": total_time,
+        "total_rows_extracted": len(all_data),
+        "avg_time_per_row": round(total_time / len(all_data), 2) if all_data else 0,
+        "skipped_pages": skipped_pages,
+        "unprocessed_pages": unprocessed_pages,
+        "stopped_for_deadline": stopped_for_deadline,
+        "extracted_data": all_data
+    }
+    if errors:
+        message["task_errors"] = errors
+    return message
+
+
+def collect_traces(job_id):
+    """ Traces recorded by the workers that ran this job's tasks """
+    conn = get_db()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT trace_events FROM page_tasks WHERE job_id = %s AND trace_events IS NOT NULL ORDER BY id", (job_id,))
+            return [row[0] for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+
+def add_queue_load(stats):
+    """
+    Adds the shared work queue's queued and running pages to a scheduler snapshot, so admission
+    checks and /user_stats see distributed jobs too. A running task counts as one page in flight.
+    """
+    conn = get_db()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT username,
+                       COUNT(DISTINCT (job_id, document_name)),
+                       COUNT(*) FILTER (WHERE status = 'running'),
+                       COALESCE(SUM(CASE WHEN status = 'queued' THEN last_page - first_page + 1
+                                         ELSE GREATEST(last_page - first_page - pages_done, 0) END), 0)
+                FROM page_tasks
+                WHERE status IN ('queued', 'running')
+                GROUP BY username
+            """)
+            rows = cursor.fetchall()
+    finally:
+        conn.close()
+
+    for username, documents, in_flight, queued in rows:
+        user = stats["users"].setdefault(username, {"active_documents": 0, "in_flight_pages": 0, "queued_pages": 0})
+        user["active_documents"] += documents
+        user["in_flight_pages"] += in_flight
+        user["queued_pages"] += int(queued)
+        stats["in_flight_pages"] += in_flight
+        stats["queued_pages"] += int(queued)
+    return stats
+
+
+# ---------------------------------------------------------------------------
+# Worker side
+# ---------------------------------------------------------------------------
+
+def claim_task(worker_id):
+    """
+    Claims the next queued task, or returns None. SKIP LOCKED keeps workers from colliding.
+    Users take turns: the task goes to the user with the fewest running tasks for their
+    share_weight, so one large batch can't hold every worker. Within a user, earliest deadline first.
+    """
+    conn = get_db()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                UPDATE page_tasks
+                SET status = 'running', lease_owner = %s, attempts = attempts + 1,
+                    lease_expires_at = CURRENT_TIMESTAMP + make_interval(secs => %s),
+                    pages_done = 0, updated_at = CURRENT_TIMESTAMP
+                WHERE id = (
+                    SELECT t.id FROM page_tasks t
+                    LEFT JOIN (
+                        SELECT username, COUNT(*) AS running FROM page_tasks WHERE status = 'running' GROUP BY username
+                    ) r ON r.username = t.username
+                    LEFT JOIN users u ON u.username = t.username
+                    WHERE t.status = 'queued' AND (t.deadline_at IS NULL OR t.deadline_at > CURRENT_TIMESTAMP)
+                    ORDER BY COALESCE(r.running, 0) / GREATEST(COALESCE(u.share_weight, 1), 0.01),
+                             t.deadline_at NULLS LAST, t.id
+                    LIMIT 1
+                    FOR UPDATE OF t SKIP LOCKED
+                )
+                RETURNING id, job_id, username, document_name, document_sha256, prompt, first_page, last_page,
+                          EXTRACT(EPOCH FROM deadline_at), regions, trace_mode, template_id, context_cache
+            """, (worker_id, LEASE_SECONDS))
+            row = cursor.fetchone()
+        conn.commit()
+    finally:
+        conn.close()
+
+    if row is None:
+        return None
+    keys = ("id", "job_id", "username", "document_name", "document_sha256", "prompt", "first_page", "last_page", "deadline", "regions",
+            "trace_mode", "template_id", "context_cache")
+    task = dict(zip(keys, row))
+    task["deadline"] = float(task["deadline"]) if task["deadline"] is not None else None
+    return task
+
+
+def heartbeat(task_id, worker_id, pages_done=None):
+    """ Extends the lease (and records progress). Raises LeaseLost if the task was requeued meanwhile. """
+    conn = get_db()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                UPDATE page_tasks
+                SET lease_expires_at = CURRENT_TIMESTAMP + make_interval(secs => %s),
+                    pages_done = COALESCE(%s, pages_done), updated_at = CURRENT_TIMESTAMP
+                WHERE id = %s AND lease_owner = %s AND status = 'running'
+            """, (LEASE_SECONDS, pages_done, task_id, worker_id))
+            owned = cursor.rowcount == 1
+        conn.commit()
+    finally:
+        conn.close()
+    if not owned:
+        raise LeaseLost(f"Task {task_id} is no longer leased to {worker_id}")
+
+
+def finish_task(task, worker_id, extracted_data, skipped_pages, unprocessed_pages, total_time, pages_done, trace=None,
+                stopped_for_deadline=False):
+    """ Stores the task's result and COPYs its rows in one transaction, so a requeued task never duplicates rows """
+    conn = get_db()
+    try:
+        ensure_partition(conn, date.today())
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                UPDATE page_tasks
+                SET status = 'done', extracted_data = %s, skipped_pages = %s, unprocessed_pages = %s, total_time = %s,
+                    pages_done = %s, trace_events = %s, stopped_for_deadline = %s,
+                    lease_owner = NULL, lease_expires_at = NULL, updated_at = CURRENT_TIMESTAMP
+                WHERE id = %s AND lease_owner = %s AND status = 'running'
+            """, (json.dumps(extracted_data), json.dumps(skipped_pages), json.dumps(unprocessed_pages), total_time,
+                  pages_done, json.dumps(trace) if trace else None, stopped_for_deadline, task["id"], worker_id))
+            if cursor.rowcount != 1:
+                conn.rollback()
+                raise LeaseLost(f"Task {task['id']} is no longer leased to {worker_id}")
+            copy_rows(cursor, [
+                (task["job_id"], task["username"], item.get("document_name", task["document_name"]), item.get("page_number"), item)
+                for item in extracted_data
+            ])
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def fail_task(task_id, worker_id, error):
+    """ Puts a failed task back in the queue, or marks it failed once it is out of attempts """
+    conn = get_db()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                UPDATE page_tasks
+                SET status = CASE WHEN attempts >= %s THEN 'failed' ELSE 'queued' END,
+                    error = %s, lease_owner = NULL, lease_expires_at = NULL, updated_at = CURRENT_TIMESTAMP
+                WHERE id = %s AND lease_owner = %s AND status = 'running'
+            """, (TASK_MAX_ATTEMPTS, error, task_id, worker_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def requeue_expired_tasks():
+    """ Returns tasks whose worker stopped heartbeating to the queue """
+    conn = get_db()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                UPDATE page_tasks
+                SET status = CASE WHEN attempts >= %s THEN 'failed' ELSE 'queued' END,
+                    error = 'lease expired on ' || lease_owner,
+                    lease_owner = NULL, lease_expires_at = NULL, updated_at = CURRENT_TIMESTAMP
+                WHERE status = 'running' AND lease_expires_at < CURRENT_TIMESTAMP
+            """, (TASK_MAX_ATTEMPTS,))
+            requeued = cursor.rowcount
+            cursor.execute("""
+                UPDATE page_tasks SET status = 'expired', updated_at = CURRENT_TIMESTAMP
+                WHERE status = 'queued' AND deadline_at < CURRENT_TIMESTAMP
+            """)
+        conn.commit()
+    finally:
+        conn.close()
+    if requeued:
+        print(f"🔁 Requeued {requeued} task(s) with expired leases")
+    return requeued
+
+
+def purge_old_tasks():
+    """ Deletes finished tasks and unreferenced documents past the retention window """
+    conn = get_db()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                DELETE FROM page_tasks
+                WHERE status IN ('done', 'failed', 'cancelled', 'expired')
+                  AND updated_at < CURRENT_TIMESTAMP - make_interval(hours => %s)
+            """, (WORK_QUEUE_RETENTION_HOURS,))
+            cursor.execute("""
+                DELETE FROM job_documents d
+                WHERE NOT EXISTS (SELECT 1 FROM page_tasks t WHERE t.document_sha256 = d.sha256)
+                  AND d.created_at < CURRENT_TIMESTAMP - make_interval(hours => %s)
+            """, (WORK_QUEUE_RETENTION_HOURS,))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _local_pdf(sha256):
+    """ Fetches a document into this node's cache once; later tasks of the same PDF reuse it """
+    os.makedirs(WORKER_CACHE_DIR, exist_ok=True)
+    path = os.path.join(WORKER_CACHE_DIR, f"{sha256}.pdf")
+    if not os.path.exists(path):
+        conn = get_db()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT content FROM job_documents WHERE sha256 = %s", (sha256,))
+                content = bytes(cursor.fetchone()[0])
+        finally:
+            conn.close()
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    return path
+
+
+def run_task(task, worker_id):
+    from pdf_processing import process_page_range
+    from data_extraction import use_context_cache
+
+    pages_done = 0
+    lease_lost = threading.Event()
+    stop_heartbeat = threading.Event()
+
+    def keep_lease():
+        # ✅ Heartbeat independently of page progress, so one slow page doesn't lose the lease
+        while not stop_heartbeat.wait(HEARTBEAT_SECONDS):
+            try:
+                heartbeat(task["id"], worker_id, pages_done)
+            except LeaseLost:
+                lease_lost.set()
+                return
+            except Exception as e:
+                print(f"🚨 Heartbeat error for task {task['id']}: {e}")
+
+    def on_page(page_number, render_seconds):
+        nonlocal pages_done
+        pages_done += 1
+        if lease_lost.is_set():
+            raise LeaseLost(f"Task {task['id']} was requeued")
+        try:
+            heartbeat(task["id"], worker_id, pages_done)
+        except LeaseLost:
+            raise  # ✅ process_page_range stops and re-raises it here, so nothing is reported done
+        except Exception as e:
+            # Progress only; keep_lease still renews the lease on its own schedule
+            print(f"🚨 Heartbeat error for task {task['id']}: {e}")
+
+    heartbeat_thread = threading.Thread(target=keep_lease, daemon=True)
+    heartbeat_thread.start()
+    start_time = time.time()
+    try:
+        pdf_path = _local_pdf(task["document_sha256"])
+        template = get_template(task["template_id"]) if task["template_id"] else None
+        if task["context_cache"]:
+            use_context_cache(task["prompt"], (template or {}).get("model"), task["context_cache"])
+        label = f"{worker_id} task {task['id']} ({task['document_name']} {task['first_page']}-{task['last_page']})"
+        with captured(task["trace_mode"], label=label) as trace:
+            all_data, skipped_pages, unprocessed_pages, stopped_for_deadline = process_page_range(
+                pdf_path, task["document_name"], task["prompt"], task["first_page"], task["last_page"],
+                on_page=on_page, deadline=task["deadline"], regions=task["regions"], template=template
+            )
+        finish_task(task, worker_id, all_data, skipped_pages, unprocessed_pages, round(time.time() - start_time, 2), pages_done,
+                    trace=trace, stopped_for_deadline=stopped_for_deadline)
+    except LeaseLost as e:
+        print(f"⚠️ {e}, dropping local work")
+    except Exception as e:
+        print(f"🚨 Task {task['id']} failed: {e}")
+        fail_task(task["id"], worker_id, str(e))
+    finally:
+        stop_heartbeat.set()
+
+
+def run_worker(stop_event=None):
+    """ Claims and runs page-range tasks until stopped. Start as many of these per node as you like. """
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    print(f"✅ Page worker {worker_id} started")
+    last_maintenance = 0
+
+    while stop_event is None or not stop_event.is_set():
+        if time.time() - last_maintenance > LEASE_SECONDS / 2:
+            try:
+                requeue_expired_tasks()
+                purge_old_tasks()
+            except Exception as e:
+                print(f"🚨 Work queue maintenance error: {e}")
+            last_maintenance = time.time()
+
+        try:
+            task = claim_task(worker_id)
+        except Exception as e:
+            print(f"🚨 Error claiming task: {e}")
+            task = None
+
+        if task is None:
+            time.sleep(WORKER_POLL_INTERVAL)
+            continue
+
+        print(f"🔹 {worker_id} running task {task['id']}: {task['document_name']} pages {task['first_page']}-{task['last_page']}")
+        run_task(task, worker_id)
+
+
+if __name__ == "__main__":
+    # Standalone page worker: python work_queue.py
+    run_worker()